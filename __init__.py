@@ -26,12 +26,20 @@ try:
     # Try relative import first
     try:
         from .prompt_enhancer_llm import PromptEnhancer
+        from . import ollama_residency
     except ImportError:
         # If that fails, try direct import
         from prompt_enhancer_llm import PromptEnhancer
+        import ollama_residency
     
     logger.info("Successfully imported PromptEnhancer class")
 
+    # Warm the configured Ollama model in the background so the first
+    # enhancement does not pay the load time.
+    ollama_residency.startup(
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "config", "llm_config.json")
+    )
+
     NODE_CLASS_MAPPINGS = {
         "PromptEnhancer": PromptEnhancer
     }
@@ -0,0 +1,211 @@
+"""Lets a ComfyUI interrupt or a deadline cut an LLM call short.
+
+Provider calls run on a helper thread while the executor thread polls
+ComfyUI's interrupt flag. When the user hits Cancel, or the call runs past its
+deadline, the executor stops waiting straight away and the helper is told to
+give up: the Ollama stream is closed between chunks (which also stops the
+server generating), and the SDK clients are closed. Whatever is left of the
+helper thread finishes in the background without holding up the queue.
+
+The node's work is written once, as a generator that yields each blocking
+provider call. ``blocking`` drives it for ComfyUI versions that call node
+functions synchronously. ``awaitable`` drives it as a coroutine for versions
+that can await node functions, so the executor can load models and run other
+ready nodes while the LLM call is in flight.
+"""
+
+import asyncio
+import contextvars
+import functools
+import inspect
+import os
+import sys
+import threading
+import time
+
+try:
+    from comfy.model_management import InterruptProcessingException, processing_interrupted
+except ImportError:
+    class InterruptProcessingException(Exception):
+        """Stand-in used when running outside ComfyUI."""
+
+    def processing_interrupted():
+        return False
+
+try:
+    from . import tracing
+except ImportError:
+    import tracing
+
+# Seconds to wait on a provider before giving up. Ollama keeps its tighter
+# limit from before; the hosted APIs previously had none at all.
+DEFAULT_TIMEOUT = 60.0
+PROVIDER_TIMEOUTS = {"ollama": 30.0}
+
+# How often the executor thread checks for an interrupt.
+POLL_INTERVAL = 0.02
+
+_cancel_event = contextvars.ContextVar("prompt_enhancer_cancel", default=None)
+_abort_callbacks = contextvars.ContextVar("prompt_enhancer_abort", default=None)
+
+
+class CallTimeout(TimeoutError):
+    """The provider call ran past its deadline."""
+
+
+def timeout_for(provider):
+    return PROVIDER_TIMEOUTS.get(provider, DEFAULT_TIMEOUT)
+
+
+def cancel_requested():
+    """True once the call running on this helper thread should stop."""
+    event = _cancel_event.get()
+    return event is not None and event.is_set()
+
+
+def on_abort(callback):
+    """Register something to close (a client, a response) if the call is aborted."""
+    callbacks = _abort_callbacks.get()
+    if callbacks is not None:
+        callbacks.append(callback)
+
+
+class _Call:
+    """A provider call running on its own helper thread."""
+
+    def __init__(self, fn, timeout):
+        self.timeout = timeout
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.cancel = threading.Event()
+        self.callbacks = []
+        self.outcome = {}
+        self.done = threading.Event()
+        # Set when this call is itself inside a call that gets aborted
+        self.parent = _cancel_event.get()
+        fn = tracing.profile_call(fn)
+
+        def target():
+            _cancel_event.set(self.cancel)
+            _abort_callbacks.set(self.callbacks)
+            try:
+                self.outcome["value"] = fn()
+            except BaseException as e:
+                self.outcome["error"] = e
+            finally:
+                self.done.set()
+
+        # Run in a copy of the caller's context so tracing spans still land
+        # in the active trace.
+        context = contextvars.copy_context()
+        thread = threading.Thread(target=context.run, args=(target,), name="prompt-enhancer-call", daemon=True)
+        thread.start()
+
+    def check(self):
+        """Abort and raise if ComfyUI was interrupted or the deadline passed."""
+        if processing_interrupted() or (self.parent is not None and self.parent.is_set()):
+            self.abort()
+            raise InterruptProcessingException()
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            self.abort()
+            raise CallTimeout(f"LLM call did not finish within {self.timeout:g}s")
+
+    def result(self):
+        if "error" in self.outcome:
+            raise self.outcome["error"]
+        return self.outcome["value"]
+
+    def abort(self):
+        self.cancel.set()
+        for callback in list(self.callbacks):
+            try:
+                callback()
+            except Exception:
+                pass
+
+
+def run_interruptible(fn, timeout=None, poll=POLL_INTERVAL):
+    """Run ``fn()`` on a helper thread and wait for it, unless interrupted.
+
+    Raises ``InterruptProcessingException`` on a ComfyUI interrupt and
+    ``CallTimeout`` past the deadline. Exceptions from ``fn`` propagate as is.
+    """
+    call = _Call(fn, timeout)
+    while not call.done.wait(poll):
+        call.check()
+    return call.result()
+
+
+async def run_interruptible_async(fn, timeout=None, poll=POLL_INTERVAL):
+    """``run_interruptible`` that yields to the event loop while it waits."""
+    call = _Call(fn, timeout)
+    while not call.done.is_set():
+        await asyncio.sleep(poll)
+        call.check()
+    return call.result()
+
+
+def drive(steps):
+    """Run a step generator to completion, blocking on each yielded call.
+
+    The generator yields ``(fn, timeout)`` pairs and receives each result
+    back (or the exception, thrown in at the yield). Its return value is
+    returned from here.
+    """
+    try:
+        request = next(steps)
+        while True:
+            try:
+                with tracing.paused():
+                    value = run_interruptible(*request)
+            except BaseException as e:
+                request = steps.throw(e)
+            else:
+                request = steps.send(value)
+    except StopIteration as stop:
+        return stop.value
+
+
+async def drive_async(steps):
+    """``drive`` as a coroutine, so other work runs during each call."""
+    try:
+        request = next(steps)
+        while True:
+            try:
+                with tracing.paused():
+                    value = await run_interruptible_async(*request)
+            except BaseException as e:
+                request = steps.throw(e)
+            else:
+                request = steps.send(value)
+    except StopIteration as stop:
+        return stop.value
+
+
+def blocking(steps):
+    """Make a plain method from a step generator method."""
+    @functools.wraps(steps)
+    def method(self, *args, **kwargs):
+        return drive(steps(self, *args, **kwargs))
+    return method
+
+
+def awaitable(steps):
+    """Make a coroutine method from a step generator method."""
+    @functools.wraps(steps)
+    async def method(self, *args, **kwargs):
+        return await drive_async(steps(self, *args, **kwargs))
+    return method
+
+
+def async_execution_supported():
+    """True when the running ComfyUI awaits coroutine node functions.
+
+    ``PROMPT_ENHANCER_ASYNC=0`` or ``=1`` overrides the detection.
+    """
+    override = os.environ.get("PROMPT_ENHANCER_ASYNC", "").strip()
+    if override:
+        return override.lower() not in ("0", "false", "no", "off")
+    # Executors with async node support run nodes through this coroutine.
+    # ComfyUI imports execution before it loads custom nodes.
+    execution = sys.modules.get("execution")
+    return inspect.iscoroutinefunction(getattr(execution, "_async_map_node_over_list", None))
@@ -19,6 +19,21 @@ const styleCategories = {
     "Period & Style": ["retro", "vintage"]
 };
 
+// Ask the backend to load the node's Ollama model so the first run is warm.
+function preloadOllama(node) {
+    const widget = (name) => node.widgets?.find(w => w.name === name);
+    if (widget("llm_provider")?.value !== "ollama") return;
+    fetch("/prompt_enhancer/ollama/preload", {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({
+            host: widget("ollama_host")?.value || "http://localhost:11434",
+            model: widget("ollama_model")?.value || "",
+            keep_alive: widget("ollama_keep_alive")?.value || "",
+        }),
+    }).catch(() => {});
+}
+
 app.registerExtension({
     name: "pinkpixel.prompt_enhancer",
     async beforeRegisterNodeDef(nodeType, nodeData, app) {
@@ -27,6 +42,19 @@ app.registerExtension({
             nodeType.prototype.onNodeCreated = function() {
                 const r = onNodeCreated ? onNodeCreated.apply(this, arguments) : undefined;
 
+                // Warm Ollama when it is picked, and when the node is placed with it selected
+                const providerWidget = this.widgets.find(w => w.name === "llm_provider");
+                if (providerWidget) {
+                    const providerCallback = providerWidget.callback;
+                    const node = this;
+                    providerWidget.callback = function() {
+                        const result = providerCallback?.apply(this, arguments);
+                        preloadOllama(node);
+                        return result;
+                    };
+                }
+                preloadOllama(this);
+
                 // Get widget indices
                 const categoryIndex = this.widgets.findIndex(w => w.name === "style_category");
                 const styleIndex = this.widgets.findIndex(w => w.name === "style");
@@ -47,6 +75,14 @@ app.registerExtension({
 
                 return r;
             };
+
+            // Saved workflows restore widget values after creation
+            const onConfigure = nodeType.prototype.onConfigure;
+            nodeType.prototype.onConfigure = function() {
+                const r = onConfigure ? onConfigure.apply(this, arguments) : undefined;
+                preloadOllama(this);
+                return r;
+            };
         }
     }
 });
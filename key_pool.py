@@ -0,0 +1,262 @@
+"""Spreads requests over several API keys per provider.
+
+One key caps throughput at that key's rate limit. Give a provider a list of
+keys in ``config/llm_config.json``:
+
+    "openai": ["sk-first", "sk-second", "sk-third"]
+
+and each request goes to the key with the most quota left, as last reported by
+the provider's rate-limit response headers, less the requests already in
+flight on it. Keys that have not reported yet are treated as having the most
+room, so every key gets measured. A key that is throttled (429) sits out until
+its limit resets, and one that is rejected (401/403) sits out for longer. The
+request is then retried on the next key.
+
+A key typed into the node joins the pool from the config. With one key the
+pool behaves exactly like a single key.
+"""
+
+import logging
+import re
+import threading
+import time
+from datetime import datetime
+
+logger = logging.getLogger('prompt_enhancer')
+
+PROVIDERS = ("openai", "anthropic", "google", "openrouter")
+
+# How long a throttled key sits out when the response says nothing about when
+# the limit resets.
+THROTTLE_EJECT = 30.0
+# How long a rejected key sits out. Long enough to stop hammering a revoked
+# key, short enough that a key fixed on the provider side comes back.
+INVALID_EJECT = 600.0
+
+# Rate-limit headers, per field, in the spellings OpenAI, Anthropic and
+# OpenRouter use.
+REMAINING_HEADERS = ("x-ratelimit-remaining-requests", "anthropic-ratelimit-requests-remaining",
+                     "x-ratelimit-remaining")
+LIMIT_HEADERS = ("x-ratelimit-limit-requests", "anthropic-ratelimit-requests-limit", "x-ratelimit-limit")
+RESET_HEADERS = ("x-ratelimit-reset-requests", "anthropic-ratelimit-requests-reset", "x-ratelimit-reset")
+
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def mask(key):
+    """Enough of a key to tell keys apart in the log."""
+    return f"...{key[-4:]}" if key else "(none)"
+
+
+def parse_reset(value, now=None):
+    """Seconds until a limit resets, from any of the header formats, or None.
+
+    Accepts plain seconds, epoch seconds or milliseconds (OpenRouter), Go
+    durations like ``6m0s`` (OpenAI) and RFC 3339 timestamps (Anthropic).
+    """
+    if value is None:
+        return None
+    value = str(value).strip()
+    now = time.time() if now is None else now
+    try:
+        number = float(value)
+    except ValueError:
+        pass
+    else:
+        if number > 1e12:
+            return max(0.0, number / 1000 - now)
+        if number > 1e9:
+            return max(0.0, number - now)
+        return max(0.0, number)
+    parts = _DURATION.findall(value)
+    if parts and "".join(n + u for n, u in parts) == value:
+        return sum(float(n) * _UNITS[u] for n, u in parts)
+    try:
+        stamp = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return max(0.0, stamp.timestamp() - now)
+
+
+def parse_headers(headers):
+    """``(remaining, limit, seconds to reset)`` from rate-limit headers. Missing fields are None."""
+    if not headers:
+        return None, None, None
+    lowered = {str(k).lower(): v for k, v in headers.items()}
+
+    def first(names):
+        for name in names:
+            if name in lowered:
+                return lowered[name]
+        return None
+
+    def number(value):
+        try:
+            return float(value) if value is not None else None
+        except ValueError:
+            return None
+
+    return number(first(REMAINING_HEADERS)), number(first(LIMIT_HEADERS)), parse_reset(first(RESET_HEADERS))
+
+
+def status_of(error):
+    """HTTP status behind an exception from any of the clients, or None.
+
+    Follows wrapped exceptions, since the providers re-raise with their own
+    message.
+    """
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        for value in (getattr(error, "status_code", None),
+                      getattr(getattr(error, "response", None), "status_code", None),
+                      getattr(error, "code", None)):
+            if isinstance(value, int) and 100 <= value < 600:
+                return value
+        error = error.__cause__ or error.__context__
+    return None
+
+
+def headers_of(error):
+    """Response headers behind an exception, or None."""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        headers = getattr(getattr(error, "response", None), "headers", None)
+        if headers is not None:
+            return headers
+        error = error.__cause__ or error.__context__
+    return None
+
+
+class _KeyState:
+    __slots__ = ("remaining", "limit", "reset_at", "ejected_until", "in_flight", "last_used")
+
+    def __init__(self):
+        self.remaining = None
+        self.limit = None
+        self.reset_at = None
+        self.ejected_until = 0.0
+        self.in_flight = 0
+        self.last_used = 0.0
+
+
+class KeyPool:
+    """Keys per provider with their last reported quota."""
+
+    def __init__(self, throttle_eject=THROTTLE_EJECT, invalid_eject=INVALID_EJECT):
+        self.throttle_eject = throttle_eject
+        self.invalid_eject = invalid_eject
+        self._lock = threading.Lock()
+        self._keys = {}   # provider -> [key, ...] in config order
+        self._state = {}  # (provider, key) -> _KeyState
+
+    def configure(self, config):
+        """Load the keys for each provider. A provider's value can be one key or a list."""
+        config = config or {}
+        with self._lock:
+            for provider in PROVIDERS:
+                value = config.get(provider) or []
+                keys = [value] if isinstance(value, str) else list(value)
+                self._keys[provider] = [key.strip() for key in keys if key and key.strip()]
+
+    def keys(self, provider, extra=""):
+        """The pool for ``provider``, with ``extra`` (the node's key) in front if set."""
+        with self._lock:
+            keys = list(self._keys.get(provider, ()))
+        extra = (extra or "").strip()
+        if extra and extra not in keys:
+            keys.insert(0, extra)
+        return keys
+
+    def _state_for(self, provider, key):
+        state = self._state.get((provider, key))
+        if state is None:
+            state = self._state[(provider, key)] = _KeyState()
+        return state
+
+    def _headroom(self, state, now):
+        """Requests this key can still take before its limit resets."""
+        if state.remaining is None or (state.reset_at is not None and now >= state.reset_at):
+            # Not measured yet, or the window has rolled over since
+            return state.limit if state.limit is not None else float("inf")
+        return state.remaining
+
+    def acquire(self, provider, extra="", exclude=()):
+        """Take the key with the most headroom, or None when there are no keys.
+
+        Call ``release`` when the request finishes. When every key is ejected,
+        the one that comes back first is used rather than failing outright.
+        """
+        keys = [key for key in self.keys(provider, extra) if key not in exclude]
+        if not keys:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            states = {key: self._state_for(provider, key) for key in keys}
+            ready = [key for key in keys if states[key].ejected_until <= now]
+            if ready:
+                # Unmeasured keys all have infinite headroom, so fewer requests
+                # in flight and then least recently used break the tie
+                key = max(ready, key=lambda k: (self._headroom(states[k], now) - states[k].in_flight,
+                                                -states[k].in_flight, -states[k].last_used))
+            else:
+                key = min(keys, key=lambda k: states[k].ejected_until)
+            state = states[key]
+            state.in_flight += 1
+            state.last_used = now
+        return key
+
+    def release(self, provider, key):
+        """Finish a request taken with ``acquire``."""
+        with self._lock:
+            state = self._state_for(provider, key)
+            state.in_flight = max(0, state.in_flight - 1)
+
+    def record(self, provider, key, headers):
+        """Update the quota of ``key`` from a response's rate-limit headers."""
+        remaining, limit, reset = parse_headers(headers)
+        now = time.monotonic()
+        with self._lock:
+            state = self._state_for(provider, key)
+            if remaining is not None:
+                state.remaining = remaining
+            if limit is not None:
+                state.limit = limit
+            if reset is not None:
+                state.reset_at = now + reset
+
+    def eject(self, provider, key, seconds):
+        with self._lock:
+            state = self._state_for(provider, key)
+            state.ejected_until = max(state.ejected_until, time.monotonic() + seconds)
+
+    def report_error(self, provider, key, error):
+        """Eject ``key`` if ``error`` says it is throttled or invalid. Returns True if it was."""
+        status = status_of(error)
+        if status == 429:
+            headers = headers_of(error) or {}
+            lowered = {str(k).lower(): v for k, v in headers.items()}
+            seconds = parse_reset(lowered.get("retry-after")) or parse_headers(headers)[2] or self.throttle_eject
+            logger.warning(f"{provider} key {mask(key)} is rate limited, resting it for {seconds:.0f}s")
+        elif status in (401, 403):
+            seconds = self.invalid_eject
+            logger.warning(f"{provider} key {mask(key)} was rejected, resting it for {seconds:.0f}s")
+        else:
+            return False
+        self.eject(provider, key, seconds)
+        return True
+
+    def ejected(self, provider, key):
+        with self._lock:
+            state = self._state.get((provider, key))
+            return state is not None and state.ejected_until > time.monotonic()
+
+    def in_flight(self, provider, key):
+        with self._lock:
+            state = self._state.get((provider, key))
+            return state.in_flight if state else 0
+
+
+pool = KeyPool()
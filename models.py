@@ -8,32 +8,61 @@ Model IDs verified against provider docs on 2026-08-16. Providers rename and
 retire models regularly, so re-check these when something starts returning 404.
 """
 
+from collections import namedtuple
+
+# Prices are USD per million input / output tokens. None means the provider has
+# not published a stable price (preview or intro pricing), and the auto router
+# skips those models whenever a cost ceiling is set. context is in tokens, None
+# where the docs do not say.
+ModelInfo = namedtuple("ModelInfo", ["id", "tier", "input_price", "output_price", "context"])
+
+# Tiers from most to least capable. The auto router picks the lowest tier that
+# suits the request.
+TIERS = ["flagship", "balanced", "fast"]
+
+# Dropdown entry that lets the router pick a model per request.
+AUTO_MODEL = "auto"
+
 # https://developers.openai.com/api/docs/models
-OPENAI_MODELS = [
-    "gpt-5.6-sol",     # flagship, $5 / $30 per Mtok
-    "gpt-5.6-terra",   # balanced, $2 / $12
-    "gpt-5.6-luna",    # cost optimized, $0.20 / $1.20
+OPENAI_MODEL_INFO = [
+    ModelInfo("gpt-5.6-sol", "flagship", 5.00, 30.00, None),
+    ModelInfo("gpt-5.6-terra", "balanced", 2.00, 12.00, None),
+    ModelInfo("gpt-5.6-luna", "fast", 0.20, 1.20, None),     # cost optimized
 ]
+OPENAI_MODELS = [m.id for m in OPENAI_MODEL_INFO]
 OPENAI_DEFAULT = "gpt-5.6-luna"
 
 # https://platform.claude.com/docs/en/about-claude/models/overview
-ANTHROPIC_MODELS = [
-    "claude-opus-5",     # flagship, $5 / $25 per Mtok
-    "claude-sonnet-5",   # balanced, $3 / $15
-    "claude-haiku-4-5",  # fastest and cheapest, $1 / $5
+ANTHROPIC_MODEL_INFO = [
+    ModelInfo("claude-opus-5", "flagship", 5.00, 25.00, None),
+    ModelInfo("claude-sonnet-5", "balanced", 3.00, 15.00, None),
+    ModelInfo("claude-haiku-4-5", "fast", 1.00, 5.00, None),  # fastest and cheapest
 ]
+ANTHROPIC_MODELS = [m.id for m in ANTHROPIC_MODEL_INFO]
 ANTHROPIC_DEFAULT = "claude-haiku-4-5"
 
 # https://ai.google.dev/gemini-api/docs/models
-GOOGLE_MODELS = [
-    "gemini-3.1-pro-preview",  # flagship, 2M context
-    "gemini-3.7-flash",        # newest workhorse, intro pricing through 2026-12-31
-    "gemini-3.6-flash",
-    "gemini-3.5-flash-lite",   # low latency, high volume
-    "gemini-3.1-flash-lite",   # cheapest, $0.25 / $1.50
+GOOGLE_MODEL_INFO = [
+    ModelInfo("gemini-3.1-pro-preview", "flagship", None, None, 2_000_000),
+    ModelInfo("gemini-3.7-flash", "balanced", None, None, None),  # intro pricing through 2026-12-31
+    ModelInfo("gemini-3.6-flash", "balanced", None, None, None),
+    ModelInfo("gemini-3.5-flash-lite", "fast", None, None, None),  # low latency, high volume
+    ModelInfo("gemini-3.1-flash-lite", "fast", 0.25, 1.50, None),  # cheapest
 ]
+GOOGLE_MODELS = [m.id for m in GOOGLE_MODEL_INFO]
 GOOGLE_DEFAULT = "gemini-3.5-flash-lite"
 
+MODEL_INFO = {
+    "openai": OPENAI_MODEL_INFO,
+    "anthropic": ANTHROPIC_MODEL_INFO,
+    "google": GOOGLE_MODEL_INFO,
+}
+DEFAULTS = {
+    "openai": OPENAI_DEFAULT,
+    "anthropic": ANTHROPIC_DEFAULT,
+    "google": GOOGLE_DEFAULT,
+}
+
 # OpenRouter exposes thousands of models, so this stays a free text field.
 # The old default (google/gemma-2-9b-it:free) was retired and now 404s.
 OPENROUTER_DEFAULT = "google/gemma-4-26b-a4b-it:free"
@@ -41,3 +70,6 @@ OPENROUTER_DEFAULT = "google/gemma-4-26b-a4b-it:free"
 # Ollama runs locally, so the model list depends on whatever the user pulled.
 OLLAMA_DEFAULT = "llama3.2:1b"
 OLLAMA_HOST_DEFAULT = "http://localhost:11434"
+# Sent with every request so the model stays loaded between queue runs.
+# Ollama's own default is five minutes, which is shorter than most sessions.
+OLLAMA_KEEP_ALIVE_DEFAULT = "30m"
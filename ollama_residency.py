@@ -0,0 +1,291 @@
+"""Keeps the configured Ollama model loaded so enhancement never pays a cold start.
+
+Ollama drops a model from memory after five idle minutes by default, and the
+next request then waits several seconds for it to load again. This module:
+
+* preloads a model (at startup from ``config/llm_config.json``, or when the node
+  is placed on the canvas via the ``/prompt_enhancer/ollama/preload`` route),
+* tracks what the server has loaded through ``/api/ps``,
+* refreshes ``keep_alive`` in the background while the ComfyUI queue has work,
+* unloads models on a local Ollama server when ComfyUI is short of memory for
+  diffusion models.
+
+Everything here is best effort. A failure is logged and never stops a run.
+"""
+
+import json
+import logging
+import threading
+import time
+from urllib.parse import urlparse
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+try:
+    from . import models
+except ImportError:
+    import models
+
+logger = logging.getLogger('prompt_enhancer')
+
+# How often the background keeper refreshes keep_alive while the queue is busy.
+REFRESH_INTERVAL = 60.0
+
+# /api/ps is cheap, but there is no point asking more often than this.
+PS_CACHE_SECONDS = 10.0
+
+LOCAL_HOSTNAMES = ("localhost", "127.0.0.1", "::1", "0.0.0.0")
+
+
+def is_local_host(host):
+    """True when the Ollama host shares this machine's RAM and VRAM."""
+    try:
+        hostname = urlparse(host).hostname or ""
+    except ValueError:
+        return False
+    return hostname.lower() in LOCAL_HOSTNAMES
+
+
+def parse_loaded_models(ps_payload):
+    """Pull model names out of an ``/api/ps`` response body."""
+    names = set()
+    for entry in (ps_payload or {}).get("models", []) or []:
+        for key in ("name", "model"):
+            if entry.get(key):
+                names.add(entry[key])
+    return names
+
+
+def _queue_is_active():
+    """True when ComfyUI has prompts running or pending."""
+    try:
+        from server import PromptServer
+        return PromptServer.instance.prompt_queue.get_tasks_remaining() > 0
+    except Exception:
+        return False
+
+
+class OllamaResidency:
+    """Tracks and refreshes Ollama models the node depends on."""
+
+    def __init__(self, keep_alive=models.OLLAMA_KEEP_ALIVE_DEFAULT, refresh_interval=REFRESH_INTERVAL):
+        self.keep_alive = keep_alive
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._tracked = {}   # (host, model) -> keep_alive
+        self._ps_cache = {}  # host -> (timestamp, set of model names)
+        self._known_hosts = set()
+        self._keeper = None
+
+    def track(self, host, model, keep_alive=None):
+        """Remember a model so the keeper refreshes it while the queue is busy."""
+        with self._lock:
+            self._tracked[(host, model)] = keep_alive or self.keep_alive
+            self._known_hosts.add(host.rstrip("/"))
+        self._ensure_keeper()
+
+    def allows(self, host):
+        """True when the preload route may send requests to ``host``.
+
+        The route takes its host from the browser, and with ``--listen`` anyone
+        who can reach ComfyUI can call it. Only this machine and hosts the
+        config or a run has already used are accepted, so it cannot be turned
+        into a way to reach other machines on the network.
+        """
+        try:
+            scheme = urlparse(host).scheme
+        except ValueError:
+            return False
+        if scheme not in ("http", "https"):
+            return False
+        if is_local_host(host):
+            return True
+        with self._lock:
+            return host.rstrip("/") in self._known_hosts
+
+    def preload(self, host, model, keep_alive=None, background=True):
+        """Ask Ollama to load ``model`` now. An empty generate request does that."""
+        self.track(host, model, keep_alive)
+        if background:
+            threading.Thread(
+                target=self._load, args=(host, model, keep_alive or self.keep_alive),
+                name="ollama-preload", daemon=True,
+            ).start()
+            return True
+        return self._load(host, model, keep_alive or self.keep_alive)
+
+    def loaded_models(self, host, refresh=False):
+        """Names of the models the server currently holds in memory."""
+        now = time.monotonic()
+        cached = self._ps_cache.get(host)
+        if cached and not refresh and now - cached[0] < PS_CACHE_SECONDS:
+            return cached[1]
+        if not requests:
+            return set()
+        try:
+            response = requests.get(f"{host}/api/ps", timeout=2)
+            response.raise_for_status()
+            names = parse_loaded_models(response.json())
+        except Exception as e:
+            logger.debug(f"Could not read loaded models from {host}: {e}")
+            names = set()
+        self._ps_cache[host] = (now, names)
+        return names
+
+    def is_loaded(self, host, model):
+        """True when ``model`` is resident. Bare names match the ``:latest`` tag."""
+        names = self.loaded_models(host)
+        return model in names or f"{model}:latest" in names
+
+    def mark_loaded(self, host, model):
+        """Record that a request just used ``model``, so it is resident."""
+        now = time.monotonic()
+        cached = self._ps_cache.get(host)
+        names = set(cached[1]) if cached else set()
+        names.add(model)
+        self._ps_cache[host] = (now, names)
+
+    def unload(self, host, model):
+        """Free the model on the server straight away."""
+        if not requests:
+            return False
+        try:
+            response = requests.post(
+                f"{host}/api/generate", json={"model": model, "keep_alive": 0}, timeout=10
+            )
+            response.raise_for_status()
+        except Exception as e:
+            logger.warning(f"Failed to unload Ollama model {model} from {host}: {e}")
+            return False
+        self._ps_cache.pop(host, None)
+        logger.info(f"Unloaded Ollama model {model} from {host}")
+        return True
+
+    def unload_local(self):
+        """Unload every tracked model served from this machine.
+
+        They also stop being tracked, so the keeper does not load them straight
+        back. The next enhancement that uses one tracks it again.
+        """
+        with self._lock:
+            targets = [key for key in self._tracked if is_local_host(key[0])]
+            for key in targets:
+                del self._tracked[key]
+        for host, model in targets:
+            if self.is_loaded(host, model):
+                self.unload(host, model)
+
+    def _load(self, host, model, keep_alive):
+        if not requests:
+            return False
+        try:
+            response = requests.post(
+                f"{host}/api/generate",
+                json={"model": model, "keep_alive": keep_alive},
+                timeout=120,
+            )
+            response.raise_for_status()
+        except Exception as e:
+            logger.warning(f"Failed to preload Ollama model {model} from {host}: {e}")
+            return False
+        self.mark_loaded(host, model)
+        logger.info(f"Ollama model {model} is loaded on {host} (keep_alive={keep_alive})")
+        return True
+
+    def _ensure_keeper(self):
+        with self._lock:
+            if self._keeper and self._keeper.is_alive():
+                return
+            self._keeper = threading.Thread(target=self._keep_warm, name="ollama-keeper", daemon=True)
+            self._keeper.start()
+
+    def _keep_warm(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            if not _queue_is_active():
+                continue
+            with self._lock:
+                tracked = list(self._tracked.items())
+            for (host, model), keep_alive in tracked:
+                self._load(host, model, keep_alive)
+
+
+residency = OllamaResidency()
+
+
+def install_memory_hook():
+    """Unload local Ollama models when ComfyUI runs short of memory.
+
+    Wraps ``comfy.model_management.free_memory``. ComfyUI calls it before
+    loading a model, and it only ever sees its own allocations, so a resident
+    Ollama model can push diffusion weights out to system RAM. When the free
+    memory on the device is below what ComfyUI asked for, the local Ollama
+    models go first.
+    """
+    try:
+        import comfy.model_management as mm
+    except ImportError:
+        return False
+    original = mm.free_memory
+    if getattr(original, "_prompt_enhancer_hook", False):
+        return True
+
+    def free_memory(memory_required, device, *args, **kwargs):
+        try:
+            if mm.get_free_memory(device) < memory_required:
+                residency.unload_local()
+        except Exception as e:
+            logger.debug(f"Ollama unload hook skipped: {e}")
+        return original(memory_required, device, *args, **kwargs)
+
+    free_memory._prompt_enhancer_hook = True
+    mm.free_memory = free_memory
+    return True
+
+
+def register_routes():
+    """Expose a preload route so the frontend can warm a model on node placement."""
+    try:
+        from aiohttp import web
+        from server import PromptServer
+    except ImportError:
+        return False
+
+    @PromptServer.instance.routes.post("/prompt_enhancer/ollama/preload")
+    async def preload_route(request):
+        data = await request.json()
+        host = (data.get("host") or "").strip()
+        model = (data.get("model") or "").strip()
+        if not host or not model:
+            return web.json_response({"ok": False, "error": "host and model are required"}, status=400)
+        if not residency.allows(host):
+            return web.json_response({"ok": False, "error": f"{host} is not a known Ollama host"}, status=403)
+        residency.preload(host, model, data.get("keep_alive") or None)
+        return web.json_response({"ok": True})
+
+    return True
+
+
+def preload_from_config(config):
+    """Warm the model named in ``llm_config.json`` (``ollama_host`` / ``ollama_model``)."""
+    model = (config or {}).get("ollama_model")
+    if not model:
+        return False
+    host = config.get("ollama_host") or models.OLLAMA_HOST_DEFAULT
+    residency.preload(host, model, config.get("ollama_keep_alive") or None)
+    return True
+
+
+def startup(config_path):
+    """Install the memory hook and routes, then warm the configured model."""
+    install_memory_hook()
+    register_routes()
+    try:
+        with open(config_path, 'r') as f:
+            config = json.load(f)
+    except (OSError, ValueError):
+        return
+    preload_from_config(config)
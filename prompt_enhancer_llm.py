@@ -1,7 +1,14 @@
 import os
 import json
+import contextvars
+import functools
+import hashlib
 import logging
+import math
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -23,10 +30,12 @@ except ImportError as e:
 
 try:
     import google.generativeai as genai_client
+    from google.ai import generativelanguage as genai_service
     logger.info("Successfully imported Google Generative AI")
 except ImportError as e:
     logger.error(f"Error importing Google Generative AI: {e}")
     genai_client = None
+    genai_service = None
 
 try:
     import requests
@@ -41,18 +50,24 @@ try:
                 "HTTP-Referer": "http://pinkpixel.dev",  # Replace with your site
                 "X-Title": "ComfyUI Prompt Enhancer"  # Name of your application
             }
+            # Keeps the TLS connection open between calls
+            self.session = requests.Session()
             logger.info("OpenRouter client initialized with API key")
         
-        def chat_completions(self, model, messages, temperature=0.7):
+        def chat_completions(self, model, messages, temperature=0.7, timeout=None, on_headers=None, seed=None):
             url = f"{self.base_url}/chat/completions"
             payload = {
                 "model": model,
                 "messages": messages,
                 "temperature": temperature
             }
+            if seed is not None:
+                payload["seed"] = seed
             logger.info(f"Making request to OpenRouter with model: {model}")
             try:
-                response = requests.post(url, headers=self.headers, json=payload)
+                response = self.session.post(url, headers=self.headers, json=payload, timeout=timeout)
+                if on_headers:
+                    on_headers(response.headers)
                 response.raise_for_status()
                 data = response.json()
                 logger.info("Successfully received response from OpenRouter")
@@ -82,11 +97,76 @@ except ImportError as e:
 try:
     # Try relative import first
     from .prompts import get_system_prompt
+    from . import prompts
     from . import models
+    from .ollama_residency import residency
+    from .tags import clean_tags as clean_tag_output
+    from . import tracing
+    from . import router
+    from . import cancellation
+    from . import response_cache
+    from . import sidecar
+    from . import timeouts
+    from . import key_pool
+    from . import wildcards
 except ImportError:
     # If that fails, try direct import
     from prompts import get_system_prompt
+    import prompts
     import models
+    from ollama_residency import residency
+    from tags import clean_tags as clean_tag_output
+    import tracing
+    import router
+    import cancellation
+    import response_cache
+    import sidecar
+    import timeouts
+    import key_pool
+    import wildcards
+
+# Seconds to wait on the Ollama probe, which reads model metadata and loads nothing
+PROBE_TIMEOUT = 5.0
+
+# Output cap for the providers that take one
+MAX_OUTPUT_TOKENS = 200
+DEFAULT_TEMPERATURE = 0.7
+# Providers take 32-bit seeds. ComfyUI's seed widgets go up to 2**64 - 1.
+SEED_RANGE = 2 ** 31
+
+# Concurrent calls per API key when enhancing wildcard variants. A local Ollama
+# server mostly queues them, so it gets fewer.
+BATCH_CONCURRENCY = 4
+PROVIDER_BATCH_CONCURRENCY = {"ollama": 2}
+
+# Guards the per-key Google clients while one is looked up or built
+_google_lock = threading.Lock()
+
+# Inputs that never change the enhanced text, left out of IS_CHANGED
+NON_DETERMINING_INPUTS = ("clip", "openai_key", "anthropic_key", "google_key", "openrouter_key",
+                          "ollama_keep_alive", "trace")
+
+
+def ollama_timings(final, first_token=None):
+    """Where an Ollama call spent its time, from the last streamed chunk.
+
+    Ollama reports durations in nanoseconds. ``prompt_eval`` is the part the
+    KV cache saves: on a repeat call with the same system prompt it covers only
+    the new tokens. ``first_token`` is measured here, in seconds.
+    """
+    timings = {}
+    for field in ("load_duration", "prompt_eval_duration", "eval_duration", "total_duration"):
+        if final.get(field) is not None:
+            timings[field.replace("_duration", "")] = round(final[field] / 1e9, 3)
+    for field in ("prompt_eval_count", "eval_count"):
+        if final.get(field) is not None:
+            timings[field] = final[field]
+    if final.get("eval_count") and final.get("eval_duration"):
+        timings["tokens_per_second"] = round(final["eval_count"] / (final["eval_duration"] / 1e9), 1)
+    if first_token is not None:
+        timings["first_token"] = round(first_token, 3)
+    return timings
+
 
 class PromptEnhancer:
     def __init__(self):
@@ -96,9 +176,13 @@ class PromptEnhancer:
         self.config_path = os.path.join(current_dir, "config", "llm_config.json")
         logger.info(f"Config path: {self.config_path}")
         self.clients = {}
+        self._sdk_clients = {}  # (provider, api key) -> client, so connections are reused
+        self._http = requests.Session() if requests else None
+        self._ollama_generate_only = set()  # hosts whose Ollama predates /api/chat
         self.api_keys = {}
         self.ollama_host = "http://localhost:11434"  # Default Ollama host
         self.enhanced_prompt = ""  # Store the enhanced prompt
+        self._empty_conditioning = None  # (clip, conditioning for "")
         self.openrouter_base_url = "https://openrouter.ai/api/v1"
         
         # Define style prompts
@@ -174,6 +258,9 @@ class PromptEnhancer:
         }
         
         self._load_config()
+        sidecar.configure(self.api_keys.get("sidecar_url"), self.api_keys.get("sidecar_token"))
+        timeouts.tracker.configure(self.api_keys.get("timeouts"))
+        key_pool.pool.configure(self.api_keys)
     
     @classmethod
     def INPUT_TYPES(cls):
@@ -205,6 +292,8 @@ class PromptEnhancer:
         return {
             "required": {
                 "clip": ("CLIP", ),
+                # The node expands {a|b} itself (see expand_wildcards), so the
+                # frontend must not pick one option before it gets here
                 "prompt": ("STRING", {"multiline": True, "default": "", "dynamicPrompts": False}),
                 "llm_provider": (providers, {"default": "openai"}),
                 "style": (all_styles, {"default": "Basic Styles > none"}),
@@ -214,169 +303,650 @@ class PromptEnhancer:
                 # back to the defaults below instead of needing the node
                 # deleted and re-added.
                 "prompt_format": (["descriptive", "tags"], {"default": "descriptive"}),
+                "clean_tags": ("BOOLEAN", {"default": True}),
+                # Ask for a negative prompt in the same call
+                "generate_negative": ("BOOLEAN", {"default": False}),
+                # Reuse the response for a prompt seen before in this process,
+                # or on this host when the sidecar is running
+                "use_cache": ("BOOLEAN", {"default": True}),
+                # Smaller system prompts cost fewer input tokens. "auto" finds the
+                # smallest one each model handles. See prompts.py
+                "system_prompt_size": (["full", "compact", "minimal", "auto"], {"default": "full"}),
                 "openai_key": ("STRING", {"multiline": False, "default": ""}),
-                "openai_model": (models.OPENAI_MODELS, {"default": models.OPENAI_DEFAULT}),
+                "openai_model": ([models.AUTO_MODEL] + models.OPENAI_MODELS, {"default": models.OPENAI_DEFAULT}),
                 "anthropic_key": ("STRING", {"multiline": False, "default": ""}),
-                "anthropic_model": (models.ANTHROPIC_MODELS, {"default": models.ANTHROPIC_DEFAULT}),
+                "anthropic_model": ([models.AUTO_MODEL] + models.ANTHROPIC_MODELS, {"default": models.ANTHROPIC_DEFAULT}),
                 "google_key": ("STRING", {"multiline": False, "default": ""}),
-                "google_model": (models.GOOGLE_MODELS, {"default": models.GOOGLE_DEFAULT}),
+                "google_model": ([models.AUTO_MODEL] + models.GOOGLE_MODELS, {"default": models.GOOGLE_DEFAULT}),
+                # Ceiling in USD per call for "auto" model selection. 0 means no ceiling.
+                "max_cost_per_call": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 1.0, "step": 0.0001}),
                 "openrouter_key": ("STRING", {"multiline": False, "default": ""}),
                 "openrouter_model": ("STRING", {"multiline": False, "default": models.OPENROUTER_DEFAULT}),
                 "ollama_host": ("STRING", {"multiline": False, "default": ""}),
-                "ollama_model": ("STRING", {"multiline": False, "default": models.OLLAMA_DEFAULT})
+                "ollama_model": ("STRING", {"multiline": False, "default": models.OLLAMA_DEFAULT}),
+                "ollama_keep_alive": ("STRING", {"multiline": False, "default": models.OLLAMA_KEEP_ALIVE_DEFAULT}),
+                # Writes a Chrome trace of each phase. See tracing.py
+                "trace": ("BOOLEAN", {"default": False}),
+                # Same seed and temperature, same enhancement, where the provider
+                # supports it. Change the seed to reroll.
+                "seed": ("INT", {"default": 0, "min": 0, "max": 0xffffffffffffffff,
+                                 "control_after_generate": "fixed"}),
+                "temperature": ("FLOAT", {"default": DEFAULT_TEMPERATURE, "min": 0.0, "max": 2.0, "step": 0.05}),
+                # Turn {red|blue} car into one prompt per variant, enhanced
+                # together and returned as lists. See wildcards.py
+                "expand_wildcards": (wildcards.MODES, {"default": "off"}),
+                "max_variants": ("INT", {"default": wildcards.DEFAULT_MAX_VARIANTS, "min": 1, "max": 1024}),
             }
         }
 
     CATEGORY = "conditioning/prompt"
-    FUNCTION = "enhance_prompt"
+    # Newer ComfyUI awaits coroutine node functions, which lets it load models
+    # and run other ready nodes while the LLM call is in flight.
+    FUNCTION = "enhance_prompt_async" if cancellation.async_execution_supported() else "enhance_prompt"
     OUTPUT_NODE = True
-    RETURN_TYPES = ("CONDITIONING", "STRING",)
-    RETURN_NAMES = ("conditioning", "enhanced_prompt",)
+    # The negative outputs come last so links in saved workflows keep their indices
+    RETURN_TYPES = ("CONDITIONING", "STRING", "CONDITIONING", "STRING",)
+    RETURN_NAMES = ("conditioning", "enhanced_prompt", "negative_conditioning", "negative_prompt",)
     INPUT_IS_LIST = False
-    OUTPUT_IS_LIST = (False, False)
+    # One entry per wildcard variant. ComfyUI runs the downstream nodes once
+    # per entry, so without wildcards this behaves like single outputs.
+    OUTPUT_IS_LIST = (True, True, True, True)
+
+    # Bumped whenever a run falls back to the original prompt, so the next
+    # queue retries instead of ComfyUI replaying the fallback from its cache
+    _fallbacks = 0
 
     @classmethod
     def DISPLAY_NAME(cls):
         return "Prompt Enhancer LLM "
 
-    def enhance_prompt(self, clip, prompt, llm_provider, style, prompt_format="descriptive",
+    @classmethod
+    def IS_CHANGED(cls, use_cache=True, **kwargs):
+        """Hash of the inputs that decide the output.
+
+        An unchanged node is skipped on re-queue. With ``use_cache`` off the
+        node always runs, as it always asks the provider.
+        """
+        if not use_cache:
+            return float("nan")
+        material = {name: value for name, value in kwargs.items() if name not in NON_DETERMINING_INPUTS}
+        material["_fallbacks"] = cls._fallbacks
+        encoded = json.dumps(material, sort_keys=True, default=str).encode("utf-8")
+        return hashlib.sha256(encoded).hexdigest()
+
+    def _enhance_steps(self, clip, prompt, llm_provider, style, prompt_format="descriptive", clean_tags=True,
                       openai_key="", openai_model=models.OPENAI_DEFAULT,
                       anthropic_key="", anthropic_model=models.ANTHROPIC_DEFAULT,
                       google_key="", google_model=models.GOOGLE_DEFAULT,
                       openrouter_key="", openrouter_model=models.OPENROUTER_DEFAULT,
-                      ollama_host=models.OLLAMA_HOST_DEFAULT, ollama_model=models.OLLAMA_DEFAULT):
-        """Enhance the input prompt using the specified LLM provider and style."""
+                      ollama_host=models.OLLAMA_HOST_DEFAULT, ollama_model=models.OLLAMA_DEFAULT,
+                      ollama_keep_alive=models.OLLAMA_KEEP_ALIVE_DEFAULT, trace=False, max_cost_per_call=0.0,
+                      system_prompt_size="full", use_cache=True, generate_negative=False, seed=0,
+                      temperature=DEFAULT_TEMPERATURE, expand_wildcards="off",
+                      max_variants=wildcards.DEFAULT_MAX_VARIANTS):
+        """Enhance the input prompt using the specified LLM provider and style.
+
+        Written as a generator that yields the blocking provider call, so the
+        same steps back both ``enhance_prompt`` and ``enhance_prompt_async``.
+        """
+        variants = [prompt]
+        with tracing.run(f"enhance_prompt ({llm_provider})", enabled=trace):
+            try:
+                if expand_wildcards != "off":
+                    with tracing.span("expand_wildcards") as expand_span:
+                        # Drawn lazily, so only max_variants prompts are ever built.
+                        # Identical variants are enhanced once.
+                        variants = list(dict.fromkeys(
+                            wildcards.expand(prompt, expand_wildcards, max_variants, seed)))
+                        expand_span.set(variants=len(variants))
+                    logger.info(f"Expanded prompt into {len(variants)} variant(s)")
+
+                if llm_provider == "none":
+                    return ([clip] * len(variants), variants, [clip] * len(variants), [""] * len(variants))
+
+                with tracing.span("style_lookup"):
+                    # Extract the actual style from the category > style format
+                    enhancement_style = style.split(" > ")[-1]
+
+                    # Skip if it's a category header
+                    if enhancement_style.startswith('[') and enhancement_style.endswith(']'):
+                        enhancement_style = "detailed"  # Use default if category header is somehow selected
+
+                    user_prompts = [f"{self.style_prompts[enhancement_style]} {variant}" for variant in variants]
+
+                model = {
+                    "openai": openai_model,
+                    "anthropic": anthropic_model,
+                    "google": google_model,
+                    "ollama": ollama_model,
+                    "openrouter": openrouter_model,
+                }.get(llm_provider)
+                # Room for the second prompt when a negative is requested
+                max_tokens = MAX_OUTPUT_TOKENS * 2 if generate_negative else MAX_OUTPUT_TOKENS
+                if model == models.AUTO_MODEL:
+                    with tracing.span("route") as route_span:
+                        # Costed against the full system prompt, the worst case.
+                        # Variants differ by a few words, so the first speaks for all.
+                        route_prompt = get_system_prompt(prompt_format, llm_provider)
+                        if generate_negative:
+                            route_prompt = prompts.with_negative_instructions(route_prompt, prompt_format)
+                        model = router.choose_model(llm_provider, variants[0], route_prompt, user_prompts[0],
+                                                    prompt_format, max_cost_per_call, max_tokens=max_tokens)
+                        route_span.set(model=model)
+                    logger.info(f"Auto selected {llm_provider} model: {model}")
+
+                with tracing.span("system_prompt") as prompt_span:
+                    size = system_prompt_size
+                    if size == "auto":
+                        size = prompts.size_selector.choose(llm_provider, model, prompt_format)
+                    system_prompt = get_system_prompt(prompt_format, llm_provider, size)
+                    if generate_negative:
+                        system_prompt = prompts.with_negative_instructions(system_prompt, prompt_format)
+                    prompt_span.set(size=size)
+
+                request = {
+                    "provider": llm_provider,
+                    "model": model,
+                    "system_prompt": system_prompt,
+                    "user_prompt": user_prompts[0],
+                    "api_key": {
+                        "openai": openai_key,
+                        "anthropic": anthropic_key,
+                        "google": google_key,
+                        "openrouter": openrouter_key,
+                    }.get(llm_provider, ""),
+                    "host": ollama_host if llm_provider == "ollama" else "",
+                    "keep_alive": ollama_keep_alive if llm_provider == "ollama" else "",
+                    "max_tokens": max_tokens,
+                    "temperature": temperature,
+                    "seed": seed % SEED_RANGE,
+                }
+                batch = [dict(request, user_prompt=user_prompt) for user_prompt in user_prompts]
+                # Sized from this model's recent latency. See timeouts.py
+                timeout = timeouts.timeout_for(llm_provider, model, request["host"], request["max_tokens"])
+
+                try:
+                    # Runs on a helper thread so Cancel in ComfyUI stops the
+                    # wait immediately instead of after the HTTP timeout.
+                    responses = yield self._batch_step(batch, timeout, use_cache)
+
+                    # In auto mode a response that breaks the format rules moves
+                    # this model up a size, and is retried once at that size
+                    if system_prompt_size == "auto":
+                        retry_size, retry = None, []
+                        for index, response in enumerate(responses):
+                            if isinstance(response, Exception):
+                                continue
+                            bigger = prompts.size_selector.report(
+                                llm_provider, model, prompt_format, size,
+                                prompts.check_output(prompt_format, prompts.split_negative(response)[0]))
+                            if bigger:
+                                retry_size = bigger
+                                retry.append(index)
+                        if retry:
+                            logger.info(f"{model} output failed the {size} prompt check, retrying with {retry_size}")
+                            retry_prompt = get_system_prompt(prompt_format, llm_provider, retry_size)
+                            if generate_negative:
+                                retry_prompt = prompts.with_negative_instructions(retry_prompt, prompt_format)
+                            retried = yield self._batch_step(
+                                [dict(batch[index], system_prompt=retry_prompt) for index in retry],
+                                timeout, use_cache)
+                            for index, response in zip(retry, retried):
+                                responses[index] = response
+                except cancellation.InterruptProcessingException:
+                    raise
+                except cancellation.CallTimeout:
+                    timeouts.tracker.record_timeout(llm_provider, model, request["host"], timeout)
+                    raise
+
+                enhanced_prompts, negative_prompts = [], []
+                if any(isinstance(response, cancellation.CallTimeout) for response in responses):
+                    timeouts.tracker.record_timeout(llm_provider, model, request["host"], timeout)
+                for variant, response in zip(variants, responses):
+                    if isinstance(response, Exception):
+                        # One failed variant keeps its original prompt, the
+                        # others keep their enhancements
+                        logger.error(f"Error enhancing prompt with {llm_provider}: {response}")
+                        PromptEnhancer._fallbacks += 1
+                        enhanced_prompts.append(variant)
+                        negative_prompts.append("")
+                        continue
+                    enhanced_prompt, negative_prompt = response, ""
+                    if generate_negative:
+                        with tracing.span("parse_negative"):
+                            enhanced_prompt, negative_prompt = prompts.split_negative(enhanced_prompt)
+
+                    # Dedupe and canonicalize tags before they take up CLIP tokens
+                    if prompt_format == "tags" and clean_tags:
+                        with tracing.span("clean_tags"):
+                            enhanced_prompt = clean_tag_output(enhanced_prompt)
+                            negative_prompt = clean_tag_output(negative_prompt)
+                    enhanced_prompts.append(enhanced_prompt)
+                    negative_prompts.append(negative_prompt)
+
+                # Store the enhanced prompt for display
+                self.enhanced_prompt = "\n".join(enhanced_prompts)
+
+                # Return conditioning and enhanced prompt
+                encoded = [self._encode_pair(clip, positive, negative)
+                           for positive, negative in zip(enhanced_prompts, negative_prompts)]
+                return ([positive for positive, _ in encoded], enhanced_prompts,
+                        [negative for _, negative in encoded], negative_prompts)
+
+            except cancellation.InterruptProcessingException:
+                # Let ComfyUI see the interrupt rather than encoding a fallback
+                logger.info("Prompt enhancement interrupted")
+                raise
+            except Exception as e:
+                logger.error(f"Error enhancing prompt with {llm_provider}: {e}")
+                PromptEnhancer._fallbacks += 1
+                # Return original prompt if enhancement fails
+                return ([self._encode(clip, variant) for variant in variants], variants,
+                        [self._encode_empty(clip)] * len(variants), [""] * len(variants))
+
+    enhance_prompt = cancellation.blocking(_enhance_steps)
+    enhance_prompt_async = cancellation.awaitable(_enhance_steps)
+
+    def _encode(self, clip, text):
+        """Create CLIP conditioning for ``text``."""
+        with tracing.span("clip.tokenize"):
+            tokens = clip.tokenize(text)
+        with tracing.span("clip.encode_from_tokens"):
+            cond, pooled = clip.encode_from_tokens(tokens, return_pooled=True)
+        return [[cond, {"pooled_output": pooled}]]
+
+    def _encode_pair(self, clip, positive, negative):
+        """Conditioning for both prompts, encoded back to back.
+
+        ComfyUI's CLIP wrapper encodes one prompt per call, so the two share a
+        single model load instead of a batch. An empty negative reuses the
+        cached empty conditioning.
+        """
+        with tracing.span("clip.tokenize"):
+            positive_tokens = clip.tokenize(positive)
+            negative_tokens = clip.tokenize(negative) if negative else None
+        with tracing.span("clip.encode_from_tokens"):
+            cond, pooled = clip.encode_from_tokens(positive_tokens, return_pooled=True)
+            if negative_tokens is None:
+                negative_conditioning = self._encode_empty(clip)
+            else:
+                negative_cond, negative_pooled = clip.encode_from_tokens(negative_tokens, return_pooled=True)
+                negative_conditioning = [[negative_cond, {"pooled_output": negative_pooled}]]
+        return [[cond, {"pooled_output": pooled}]], negative_conditioning
+
+    def _encode_empty(self, clip):
+        """Conditioning for an empty prompt, cached per CLIP model."""
+        cached = self._empty_conditioning
+        if cached is None or cached[0] is not clip:
+            cached = (clip, self._encode(clip, ""))
+            self._empty_conditioning = cached
+        return cached[1]
+
+    def _batch_step(self, batch, timeout=None, use_cache=True):
+        """The ``(fn, timeout)`` step that enhances the ``batch`` of requests concurrently.
+
+        Each request in a larger batch has its own ``timeout``, so the step
+        allows that for each round of concurrent calls, plus a little so the
+        requests' own deadlines fire first.
+        """
+        workers = self._batch_workers(batch[0])
+        step = functools.partial(self._complete_batch, batch, timeout, use_cache, workers)
+        if len(batch) == 1 or not timeout:
+            return step, timeout
+        return step, timeout * math.ceil(len(batch) / workers) + timeouts.READ_SLACK
+
+    def _batch_workers(self, request):
+        """Concurrent calls for a batch, scaled with the number of pooled keys."""
+        provider = request["provider"]
+        keys = len(key_pool.pool.keys(provider, request.get("api_key", ""))) if provider in key_pool.PROVIDERS else 1
+        return PROVIDER_BATCH_CONCURRENCY.get(provider, BATCH_CONCURRENCY) * max(1, keys)
+
+    def _complete_batch(self, batch, timeout=None, use_cache=True, workers=BATCH_CONCURRENCY):
+        """``_complete`` for each request in ``batch``, several at a time.
+
+        Returns each response, or the exception that request raised, in order.
+        A request that runs past ``timeout`` gets a ``CallTimeout`` while the
+        others carry on. Duplicates are answered once through the response
+        cache.
+        """
+        def complete(request):
+            if cancellation.cancel_requested():
+                raise cancellation.InterruptProcessingException()
+            try:
+                if len(batch) == 1:
+                    return self._complete(request, timeout, use_cache)
+                return cancellation.run_interruptible(
+                    functools.partial(self._complete, request, timeout, use_cache), timeout)
+            except cancellation.InterruptProcessingException:
+                raise
+            except Exception as e:
+                return e
+
+        if len(batch) == 1:
+            return [complete(batch[0])]
+        with ThreadPoolExecutor(min(workers, len(batch)), thread_name_prefix="prompt-enhancer-batch") as pool:
+            # Each call gets its own copy of the context, so it sees this
+            # call's cancel flag and its spans land in the active trace
+            futures = [pool.submit(contextvars.copy_context().run, tracing.profile_call(complete), request)
+                       for request in batch]
+            return [future.result() for future in futures]
+
+    def _complete(self, request, timeout=None, use_cache=True):
+        """Get the response for ``request`` from the sidecar, the cache or the provider."""
+        client = sidecar.client()
+        if client.available():
+            try:
+                with tracing.span("sidecar"):
+                    return client.enhance(request, timeout, use_cache)
+            except sidecar.SidecarUnavailable as e:
+                logger.warning(f"Enhancement sidecar failed ({e}), working in process")
+        if not use_cache:
+            return self._call_provider(request, timeout)
+        with tracing.span("cache") as cache_span:
+            enhanced_prompt, cached = response_cache.cache.get_or_compute(
+                response_cache.cache_key(request), lambda: self._call_provider(request, timeout))
+            cache_span.set(hit=cached)
+        return enhanced_prompt
+
+    def _call_provider(self, request, timeout=None):
+        """Send ``request`` to its provider and record the latency for the router."""
+        provider = request["provider"]
+        model = request["model"]
+
+        started = time.perf_counter()
         try:
-            if llm_provider == "none":
-                return (clip, prompt)
+            enhanced_prompt = self._call_with_pool(request, timeout)
+        except cancellation.InterruptProcessingException:
+            raise
+        except Exception:
+            router.stats.record_error(provider, model)
+            raise
+        latency = time.perf_counter() - started
+        router.stats.record(provider, model, latency)
+        timeouts.tracker.record(provider, model, request.get("host", ""), latency, enhanced_prompt)
+        return enhanced_prompt
 
-            # Extract the actual style from the category > style format
-            enhancement_style = style.split(" > ")[-1]
-            
-            # Skip if it's a category header
-            if enhancement_style.startswith('[') and enhancement_style.endswith(']'):
-                enhancement_style = "detailed"  # Use default if category header is somehow selected
+    def _call_with_pool(self, request, timeout=None):
+        """Make the call with the pooled key that has the most quota left.
 
-            system_prompt = get_system_prompt(prompt_format, llm_provider)
-            user_prompt = f"{self.style_prompts[enhancement_style]} {prompt}"
-            
-            # Handle each provider
-            if llm_provider == "openai":
-                if not openai_key:
-                    raise ValueError("OpenAI API key is required")
-                client = OpenAI(api_key=openai_key)
-                response = client.chat.completions.create(
-                    model=openai_model,
+        A throttled or rejected key is rested and the call moves on to the
+        next key, until every key has been tried.
+        """
+        provider = request["provider"]
+        node_key = request.get("api_key", "")
+        if provider not in key_pool.PROVIDERS:
+            return self._dispatch(request, "", timeout)
+        tried = []
+        while True:
+            api_key = key_pool.pool.acquire(provider, node_key, exclude=tried)
+            if api_key is None:
+                # No keys at all. The provider method reports the missing key.
+                return self._dispatch(request, "", timeout)
+            try:
+                return self._dispatch(request, api_key, timeout)
+            except cancellation.InterruptProcessingException:
+                raise
+            except Exception as e:
+                tried.append(api_key)
+                if (not key_pool.pool.report_error(provider, api_key, e) or cancellation.cancel_requested()
+                        or len(tried) >= len(key_pool.pool.keys(provider, node_key))):
+                    raise
+                logger.info(f"Retrying {provider} request with another key")
+            finally:
+                key_pool.pool.release(provider, api_key)
+
+    def _dispatch(self, request, api_key, timeout=None):
+        """Call the provider method for ``request`` with ``api_key``."""
+        provider = request["provider"]
+        model = request["model"]
+        system_prompt = request["system_prompt"]
+        user_prompt = request["user_prompt"]
+        max_tokens = request.get("max_tokens", MAX_OUTPUT_TOKENS)
+        temperature = request.get("temperature", DEFAULT_TEMPERATURE)
+        seed = request.get("seed")
+
+        if provider == "openai":
+            return self._enhance_openai(system_prompt, user_prompt, api_key, model, timeout, max_tokens,
+                                        temperature, seed)
+        elif provider == "anthropic":
+            return self._enhance_anthropic(system_prompt, user_prompt, api_key, model, timeout, max_tokens,
+                                           temperature)
+        elif provider == "google":
+            return self._enhance_google(system_prompt, user_prompt, api_key, model, timeout, temperature)
+        elif provider == "ollama":
+            return self._enhance_ollama(system_prompt, user_prompt, request.get("host", ""), model,
+                                        request.get("keep_alive", ""), timeout, temperature, seed)
+        elif provider == "openrouter":
+            return self._enhance_openrouter(system_prompt, user_prompt, api_key, model, timeout, temperature, seed)
+        raise ValueError(f"Unknown provider: {provider}")
+
+    def _sdk_client(self, provider, api_key, timeout=None):
+        """A cached OpenAI or Anthropic client for ``api_key``, with ``timeout`` applied."""
+        key = (provider, api_key)
+        client = self._sdk_clients.get(key)
+        if client is None:
+            client = OpenAI(api_key=api_key) if provider == "openai" else anthropic.Client(api_key=api_key)
+            self._sdk_clients[key] = client
+
+        def drop():
+            # Closing the shared client is the only way to cut its connection.
+            # The next call builds a fresh one.
+            if self._sdk_clients.get(key) is client:
+                del self._sdk_clients[key]
+            client.close()
+
+        cancellation.on_abort(drop)
+        return client.with_options(timeout=timeouts.sdk_timeout(timeout)) if timeout else client
+
+    def _enhance_openai(self, system_prompt, user_prompt, api_key, model, timeout=None,
+                        max_tokens=MAX_OUTPUT_TOKENS, temperature=DEFAULT_TEMPERATURE, seed=None):
+        if not api_key:
+            raise ValueError("OpenAI API key is required")
+        with tracing.span("client", provider="openai"):
+            client = self._sdk_client("openai", api_key, timeout)
+        with tracing.span("request", provider="openai", model=model):
+            # The raw response carries the rate-limit headers for the key pool
+            raw = client.chat.completions.with_raw_response.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt}
+                ],
+                max_tokens=max_tokens,
+                temperature=temperature,
+                # Best effort on OpenAI's side, but repeat calls mostly match
+                **({"seed": seed} if seed is not None else {})
+            )
+            key_pool.pool.record("openai", api_key, raw.headers)
+        with tracing.span("parse"):
+            response = raw.parse()
+            return response.choices[0].message.content.strip()
+
+    def _enhance_anthropic(self, system_prompt, user_prompt, api_key, model, timeout=None,
+                           max_tokens=MAX_OUTPUT_TOKENS, temperature=DEFAULT_TEMPERATURE):
+        if not api_key:
+            raise ValueError("Anthropic API key is required")
+        with tracing.span("client", provider="anthropic"):
+            client = self._sdk_client("anthropic", api_key, timeout)
+        with tracing.span("request", provider="anthropic", model=model):
+            # No seed parameter. Temperature tops out at 1 here.
+            raw = client.messages.with_raw_response.create(
+                model=model,
+                max_tokens=max_tokens,
+                temperature=min(temperature, 1.0),
+                messages=[
+                    {"role": "user", "content": f"{system_prompt}\n\n{user_prompt}"}
+                ]
+            )
+            key_pool.pool.record("anthropic", api_key, raw.headers)
+        with tracing.span("parse"):
+            response = raw.parse()
+            return response.content[0].text.strip()
+
+    def _google_model(self, api_key, model):
+        """A Gemini model bound to its own client for ``api_key``.
+
+        ``genai_client.configure`` sets one key for the whole process, so
+        concurrent calls on pooled keys would go out on whichever key was set
+        last. ``GenerativeModel`` has no client argument, but uses ``_client``
+        when it is set.
+        """
+        with _google_lock:
+            client = self._sdk_clients.get(("google", api_key))
+            if client is None:
+                client = genai_service.GenerativeServiceClient(client_options={"api_key": api_key})
+                self._sdk_clients[("google", api_key)] = client
+            generative_model = genai_client.GenerativeModel(model)
+            generative_model._client = client
+        return generative_model
+
+    def _enhance_google(self, system_prompt, user_prompt, api_key, model, timeout=None,
+                        temperature=DEFAULT_TEMPERATURE):
+        if not api_key:
+            raise ValueError("Google API key is required")
+        with tracing.span("client", provider="google"):
+            client = self._google_model(api_key, model)
+        with tracing.span("request", provider="google", model=model):
+            response = client.generate_content(
+                f"{system_prompt}\n\n{user_prompt}",
+                generation_config={"temperature": temperature},
+                request_options={"timeout": timeout} if timeout else None
+            )
+        with tracing.span("parse"):
+            return response.text.strip()
+
+    def _enhance_ollama(self, system_prompt, user_prompt, ollama_host, ollama_model, ollama_keep_alive,
+                        timeout=cancellation.PROVIDER_TIMEOUTS["ollama"], temperature=DEFAULT_TEMPERATURE,
+                        seed=None):
+        if not requests:
+            raise ValueError("Requests package is required for Ollama support")
+
+        # Use provided host or default
+        host = ollama_host.strip() if ollama_host.strip() else models.OLLAMA_HOST_DEFAULT
+        model_name = ollama_model.strip() if ollama_model.strip() else models.OLLAMA_DEFAULT
+        keep_alive = ollama_keep_alive.strip() or models.OLLAMA_KEEP_ALIVE_DEFAULT
+
+        logger.info(f"Using Ollama host: {host}, model: {model_name}")
+
+        # A resident model already proves the server is up, so only
+        # probe when it is not loaded. The probe checks the model exists
+        # without loading it. Loading happens in the call below, within
+        # its deadline.
+        with tracing.span("client", provider="ollama"):
+            if not residency.is_loaded(host, model_name):
+                success, message = self._test_ollama_connection(host, model_name)
+                if not success:
+                    raise ValueError(f"Ollama connection failed: {message}")
+            residency.track(host, model_name, keep_alive)
+
+        # The system prompt goes in its own message and never changes between
+        # calls, so the server finds it already evaluated in its KV cache and
+        # only the style and user prompt are new work. Servers without
+        # /api/chat get the same split through /api/generate's system field.
+        def post(chat):
+            payload = {
+                "model": model_name,
+                # Streamed so a cancel can drop the connection between chunks,
+                # which also makes Ollama stop generating.
+                "stream": True,
+                "keep_alive": keep_alive,
+                # Sampling options don't affect the KV cache or force a reload
+                "options": {"temperature": temperature, **({"seed": seed} if seed is not None else {})},
+            }
+            if chat:
+                payload["messages"] = [
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt},
+                ]
+            else:
+                payload["system"] = system_prompt
+                payload["prompt"] = user_prompt
+            url = f"{host}/api/chat" if chat else f"{host}/api/generate"
+            response = self._http.post(url, json=payload, timeout=timeouts.http_timeout(timeout), stream=True)
+            cancellation.on_abort(response.close)
+            return response
+
+        chat = host not in self._ollama_generate_only
+        try:
+            with tracing.span("request", provider="ollama", model=model_name) as request_span:
+                started = time.perf_counter()
+                response = post(chat)
+                if chat and response.status_code == 404 and "model" not in response.text.lower():
+                    # Ollama from before /api/chat. Remember, and ask again.
+                    response.close()
+                    logger.info(f"Ollama at {host} has no /api/chat, using /api/generate")
+                    self._ollama_generate_only.add(host)
+                    chat = False
+                    response = post(chat)
+                response.raise_for_status()
+                chunks = []
+                first_token = None
+                final = {}
+                for line in response.iter_lines():
+                    if cancellation.cancel_requested():
+                        response.close()
+                        raise cancellation.InterruptProcessingException()
+                    if not line:
+                        continue
+                    data = json.loads(line)
+                    if data.get("error"):
+                        raise ValueError(f"Ollama error: {data['error']}")
+                    text = data.get("message", {}).get("content", "") if chat else data.get("response", "")
+                    if text and first_token is None:
+                        first_token = time.perf_counter() - started
+                    chunks.append(text)
+                    if data.get("done"):
+                        final = data
+                        break
+                response.close()
+                timings = ollama_timings(final, first_token)
+                request_span.set(**timings)
+                if timings:
+                    logger.info("Ollama timings: " + ", ".join(f"{k}={v}" for k, v in timings.items()))
+            enhanced_prompt = "".join(chunks).strip()
+        except requests.exceptions.RequestException as e:
+            raise ValueError(f"Ollama API error: {str(e)}")
+
+        if not enhanced_prompt:
+            raise ValueError("Empty response from Ollama")
+        residency.mark_loaded(host, model_name)
+        return enhanced_prompt
+
+    def _enhance_openrouter(self, system_prompt, user_prompt, api_key, model, timeout=None,
+                            temperature=DEFAULT_TEMPERATURE, seed=None):
+        if not api_key:
+            raise ValueError("OpenRouter API key is required")
+
+        with tracing.span("client", provider="openrouter"):
+            # One client per key, so pooled keys each keep their own session
+            client = self._sdk_clients.get(("openrouter", api_key))
+            if client is None:
+                client = self._sdk_clients[("openrouter", api_key)] = OpenRouter(api_key=api_key)
+
+        try:
+            with tracing.span("request", provider="openrouter", model=model):
+                response = client.chat_completions(
+                    model=model,
                     messages=[
                         {"role": "system", "content": system_prompt},
                         {"role": "user", "content": user_prompt}
                     ],
-                    max_tokens=200,
-                    temperature=0.7
-                )
-                enhanced_prompt = response.choices[0].message.content.strip()
-                
-            elif llm_provider == "anthropic":
-                if not anthropic_key:
-                    raise ValueError("Anthropic API key is required")
-                client = anthropic.Client(api_key=anthropic_key)
-                response = client.messages.create(
-                    model=anthropic_model,
-                    max_tokens=200,
-                    messages=[
-                        {"role": "user", "content": f"{system_prompt}\n\n{user_prompt}"}
-                    ]
+                    temperature=temperature,
+                    seed=seed,
+                    timeout=timeouts.http_timeout(timeout),
+                    on_headers=lambda headers: key_pool.pool.record("openrouter", api_key, headers)
                 )
-                enhanced_prompt = response.content[0].text.strip()
-                
-            elif llm_provider == "google":
-                if not google_key:
-                    raise ValueError("Google API key is required")
-                genai_client.configure(api_key=google_key)
-                model = genai_client.GenerativeModel(google_model)
-                response = model.generate_content(
-                    f"{system_prompt}\n\n{user_prompt}"
-                )
-                enhanced_prompt = response.text.strip()
-                
-            elif llm_provider == "ollama":
-                if not requests:
-                    raise ValueError("Requests package is required for Ollama support")
-                
-                # Use provided host or default
-                host = ollama_host.strip() if ollama_host.strip() else models.OLLAMA_HOST_DEFAULT
-                model_name = ollama_model.strip() if ollama_model.strip() else models.OLLAMA_DEFAULT
-                
-                logger.info(f"Using Ollama host: {host}, model: {model_name}")
-                
-                # Test Ollama connection
-                success, message = self._test_ollama_connection(host, model_name)
-                if not success:
-                    raise ValueError(f"Ollama connection failed: {message}")
-                                
-                url = f"{host}/api/generate"
-                payload = {
-                    "model": model_name,
-                    "prompt": f"{system_prompt}\n\n{user_prompt}",
-                    "stream": False
-                }
-                
-                try:
-                    response = requests.post(url, json=payload, timeout=30)
-                    response.raise_for_status()
-                    response_data = response.json()
-                    enhanced_prompt = response_data.get("response", "").strip()
-                    
-                    if not enhanced_prompt:
-                        raise ValueError("Empty response from Ollama")
-                        
-                except requests.exceptions.RequestException as e:
-                    raise ValueError(f"Ollama API error: {str(e)}")
-                    
-            elif llm_provider == "openrouter":
-                if not openrouter_key:
-                    raise ValueError("OpenRouter API key is required")
-                
-                if llm_provider not in self.clients:
-                    self._initialize_client(llm_provider, openrouter_key)
-                
-                try:
-                    response = self.clients[llm_provider].chat_completions(
-                        model=openrouter_model,
-                        messages=[
-                            {"role": "system", "content": system_prompt},
-                            {"role": "user", "content": user_prompt}
-                        ],
-                        temperature=0.7
-                    )
-                    
-                    if 'choices' not in response or not response['choices']:
-                        raise ValueError("No choices in OpenRouter response")
-                    
-                    enhanced_prompt = response['choices'][0]['message']['content'].strip()
-                    logger.info(f"Enhanced prompt from OpenRouter: {enhanced_prompt}")
-                except Exception as e:
-                    logger.error(f"Error processing OpenRouter response: {str(e)}")
-                    raise RuntimeError(f"Failed to enhance prompt with OpenRouter: {str(e)}")
-            
-            # Store the enhanced prompt for display
-            self.enhanced_prompt = enhanced_prompt
 
-            # Create CLIP conditioning
-            tokens = clip.tokenize(enhanced_prompt)
-            cond, pooled = clip.encode_from_tokens(tokens, return_pooled=True)
+            with tracing.span("parse"):
+                if 'choices' not in response or not response['choices']:
+                    raise ValueError("No choices in OpenRouter response")
 
-            # Return conditioning and enhanced prompt
-            conditioning = [[cond, {"pooled_output": pooled}]]
-            return (conditioning, enhanced_prompt)
-            
+                enhanced_prompt = response['choices'][0]['message']['content'].strip()
+            logger.info(f"Enhanced prompt from OpenRouter: {enhanced_prompt}")
+            return enhanced_prompt
         except Exception as e:
-            logger.error(f"Error enhancing prompt with {llm_provider}: {e}")
-            # Return original prompt if enhancement fails
-            tokens = clip.tokenize(prompt)
-            cond, pooled = clip.encode_from_tokens(tokens, return_pooled=True)
-            conditioning = [[cond, {"pooled_output": pooled}]]
-            return (conditioning, prompt)
+            logger.error(f"Error processing OpenRouter response: {str(e)}")
+            raise RuntimeError(f"Failed to enhance prompt with OpenRouter: {str(e)}")
 
     @classmethod
     def WIDGETS(cls):
@@ -502,15 +1072,14 @@ class PromptEnhancer:
             if not host.startswith(('http://', 'https://')):
                 return False, f"Invalid Ollama host URL: {host}. Must start with http:// or https://"
                 
-            url = f"{host}/api/generate"
+            # /api/show answers from the model files without loading the
+            # model, so a slow load is left to the real call and its deadline
+            url = f"{host}/api/show"
             try:
-                response = requests.post(url, json={
-                    "model": model,
-                    "prompt": "test",
-                    "stream": False
-                }, timeout=5)
+                response = self._http.post(url, json={"model": model, "name": model},
+                                           timeout=timeouts.http_timeout(PROBE_TIMEOUT))
                 
-                if response.status_code == 404 and "model not found" in response.text.lower():
+                if response.status_code == 404:
                     return False, f"Model {model} not found. Please run 'ollama pull {model}' first."
                 elif response.status_code != 200:
                     return False, f"Failed to connect to Ollama server at {host}: {response.text}"
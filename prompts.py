@@ -7,8 +7,19 @@ Two output formats are supported:
 
 Ollama keeps its own descriptive prompt because smaller local models respond
 better when told to lead with the focus object.
+
+Each prompt comes in three sizes. ``full`` is the original wording. ``compact``
+keeps the rules that change the output and drops the examples. ``minimal`` is
+a couple of sentences. The system prompt is resent on every call, and on a
+small local model evaluating it can take longer than generating the answer, so
+the smaller sizes are worth having when the model copes with them.
+``SizeSelector`` finds out which size that is, per provider and model, by
+checking the outputs.
 """
 
+import re
+import threading
+
 DESCRIPTIVE_SYSTEM_PROMPT = (
     "You are an expert at writing image generation prompts. Convert the input into a clear, "
     "descriptive prompt that directly describes the desired image. Focus on nouns, adjectives, "
@@ -177,10 +188,195 @@ Do not provide negative prompts unless requested.
 Your sole output must be the optimized, comma-separated SDXL tag prompt."""
 
 
-def get_system_prompt(prompt_format, llm_provider):
-    """Pick the system prompt for a provider and output format."""
+DESCRIPTIVE_SYSTEM_PROMPT_COMPACT = (
+    "Rewrite the input as a Stable Diffusion image prompt. Describe the image directly with nouns, "
+    "adjectives and visual details, in at most 5 plain sentences. No instructions like 'create' or "
+    "'imagine', no named characters or franchises unless asked, no quotes, no formatting. Output only "
+    "the prompt."
+)
+
+OLLAMA_DESCRIPTIVE_SYSTEM_PROMPT_COMPACT = (
+    "Rewrite the input as a Stable Diffusion image prompt. Start with the focus object, then describe "
+    "the image with nouns, adjectives and visual details, in at most 5 plain sentences. No instructions "
+    "like 'create', no quotes, no formatting. Output only the prompt."
+)
+
+TAG_SYSTEM_PROMPT_COMPACT = """Convert the user's image description into an SDXL prompt of comma-separated Danbooru-style tags.
+Output only the tags on one line: no sentences, explanations, markdown, quotes or "Prompt:" prefix.
+Order: quality/style, subject (1girl, solo...), appearance, hair, eyes, clothing, pose/action, expression, camera/composition, environment, background, lighting, colors, rendering.
+Use concise, concrete visual tags (long silver hair, cinematic lighting) rather than prose, and turn feelings into visuals (nervous -> nervous expression).
+Keep every detail the user gave, keep requested styles, and do not invent objects, characters or styles they did not imply.
+No duplicate or synonym-stacked tags. Use (tag:1.2) weights only for key concepts."""
+
+DESCRIPTIVE_SYSTEM_PROMPT_MINIMAL = (
+    "Rewrite the input as a plain-text Stable Diffusion prompt of at most 5 descriptive sentences. "
+    "Output only the prompt."
+)
+
+OLLAMA_DESCRIPTIVE_SYSTEM_PROMPT_MINIMAL = (
+    "Rewrite the input as a plain-text Stable Diffusion prompt of at most 5 descriptive sentences, "
+    "starting with the focus object. Output only the prompt."
+)
+
+TAG_SYSTEM_PROMPT_MINIMAL = (
+    "Convert the description into one line of comma-separated SDXL/Danbooru tags, subject first. "
+    "Output only the tags."
+)
+
+SIZES = ["minimal", "compact", "full"]
+
+SYSTEM_PROMPTS = {
+    ("descriptive", "full"): DESCRIPTIVE_SYSTEM_PROMPT,
+    ("descriptive", "compact"): DESCRIPTIVE_SYSTEM_PROMPT_COMPACT,
+    ("descriptive", "minimal"): DESCRIPTIVE_SYSTEM_PROMPT_MINIMAL,
+    ("ollama_descriptive", "full"): OLLAMA_DESCRIPTIVE_SYSTEM_PROMPT,
+    ("ollama_descriptive", "compact"): OLLAMA_DESCRIPTIVE_SYSTEM_PROMPT_COMPACT,
+    ("ollama_descriptive", "minimal"): OLLAMA_DESCRIPTIVE_SYSTEM_PROMPT_MINIMAL,
+    ("tags", "full"): TAG_SYSTEM_PROMPT,
+    ("tags", "compact"): TAG_SYSTEM_PROMPT_COMPACT,
+    ("tags", "minimal"): TAG_SYSTEM_PROMPT_MINIMAL,
+}
+
+# Token counts from count_tokens. Rerun it after editing a prompt;
+# test_prompt_enhancer.py fails while this table is out of date.
+SYSTEM_PROMPT_TOKENS = {
+    ("descriptive", "full"): 151,
+    ("descriptive", "compact"): 71,
+    ("descriptive", "minimal"): 27,
+    ("ollama_descriptive", "full"): 130,
+    ("ollama_descriptive", "compact"): 61,
+    ("ollama_descriptive", "minimal"): 34,
+    ("tags", "full"): 1954,
+    ("tags", "compact"): 200,
+    ("tags", "minimal"): 28,
+}
+
+_TOKEN_RE = re.compile(r"[A-Za-z]+|[0-9]+|[^\sA-Za-z0-9]")
+
+
+def count_tokens(text):
+    """Estimate the BPE token count of ``text`` without a tokenizer dependency.
+
+    Punctuation counts as one token each, numbers and words of up to six
+    letters as one, and longer words as one per six letters, which is how
+    GPT and Llama style tokenizers tend to split English. It is an estimate,
+    meant for comparing prompt sizes rather than billing.
+    """
+    total = 0
+    for piece in _TOKEN_RE.findall(text):
+        total += -(-len(piece) // 6) if piece.isalpha() else 1
+    return total
+
+
+def _variant(prompt_format, llm_provider):
     if prompt_format == "tags":
-        return TAG_SYSTEM_PROMPT
+        return "tags"
     if llm_provider == "ollama":
-        return OLLAMA_DESCRIPTIVE_SYSTEM_PROMPT
-    return DESCRIPTIVE_SYSTEM_PROMPT
+        return "ollama_descriptive"
+    return "descriptive"
+
+
+def get_system_prompt(prompt_format, llm_provider, size="full"):
+    """Pick the system prompt for a provider, output format and size."""
+    return SYSTEM_PROMPTS[(_variant(prompt_format, llm_provider), size)]
+
+
+# Appended to the system prompt when the node also wants a negative prompt,
+# so one call returns both.
+NEGATIVE_PROMPT_INSTRUCTIONS = {
+    "descriptive": (
+        "\n\nAlso write a negative prompt: a comma separated list of things that would spoil this "
+        "image (artifacts, unwanted objects, wrong styles). Answer in exactly this form, with nothing "
+        "before or after:\nPOSITIVE: <the prompt>\nNEGATIVE: <the negative prompt>"
+    ),
+    "tags": (
+        "\n\nAlso write a negative prompt as comma-separated tags for things to avoid in this image "
+        "(e.g. lowres, bad anatomy, extra fingers, watermark, plus anything conflicting with the scene). "
+        "Answer in exactly this form, with nothing before or after:\nPOSITIVE: <tags>\nNEGATIVE: <tags>"
+    ),
+}
+
+# Labels may come wrapped in markdown bold or headings.
+_POSITIVE_RE = re.compile(r"^[*_#\s]*positive(?: prompt)?[*_\s]*:[*_\s]*", re.IGNORECASE | re.MULTILINE)
+_NEGATIVE_RE = re.compile(r"^[*_#\s]*negative(?: prompt)?[*_\s]*:[*_\s]*", re.IGNORECASE | re.MULTILINE)
+
+
+def with_negative_instructions(system_prompt, prompt_format):
+    """``system_prompt`` extended to ask for a labelled negative prompt too."""
+    return system_prompt + NEGATIVE_PROMPT_INSTRUCTIONS.get(prompt_format, NEGATIVE_PROMPT_INSTRUCTIONS["descriptive"])
+
+
+def split_negative(text):
+    """Split a ``POSITIVE: ... NEGATIVE: ...`` response into its two prompts.
+
+    A response without a ``NEGATIVE:`` label is all positive, with an empty
+    negative, so a model that ignores the format still gives a usable prompt.
+    """
+    negative = _NEGATIVE_RE.search(text)
+    if negative:
+        positive_part, negative_part = text[:negative.start()], text[negative.end():]
+    else:
+        positive_part, negative_part = text, ""
+    positive_part = _POSITIVE_RE.sub("", positive_part, count=1)
+    return positive_part.strip(), negative_part.strip()
+
+
+def larger_size(size):
+    """The next size up, or None when ``size`` is already the largest."""
+    index = SIZES.index(size)
+    return SIZES[index + 1] if index + 1 < len(SIZES) else None
+
+
+_MARKDOWN_RE = re.compile(r"^\s*(#|[-*•]\s|\d+\.\s)|\*\*|`", re.MULTILINE)
+_PREAMBLE_RE = re.compile(r"^\s*(here (is|are)|here's|sure|certainly|prompt:|tags:)", re.IGNORECASE)
+# A tag should be a short phrase. Anything longer is a sentence.
+MAX_WORDS_PER_TAG = 8
+MIN_TAGS = 3
+MAX_SENTENCES = 8
+
+
+def check_output(prompt_format, text):
+    """Cheap check that a response follows its format's rules."""
+    text = text.strip()
+    if not text or _MARKDOWN_RE.search(text) or _PREAMBLE_RE.match(text):
+        return False
+    if prompt_format == "tags":
+        tags = [tag.strip() for tag in text.split(",") if tag.strip()]
+        if len(tags) < MIN_TAGS or "\n\n" in text:
+            return False
+        return all(len(tag.split()) <= MAX_WORDS_PER_TAG and not tag.endswith(".") for tag in tags)
+    sentences = [part for part in re.split(r"[.!?]+\s", text) if part.strip()]
+    return len(sentences) <= MAX_SENTENCES
+
+
+class SizeSelector:
+    """Remembers the smallest system prompt size that works per model.
+
+    Every (provider, model, format) starts at ``minimal``. A response that
+    fails ``check_output`` moves it up one size for good, so a model settles
+    on the smallest prompt it handles after a call or two.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sizes = {}
+
+    def choose(self, llm_provider, model, prompt_format):
+        with self._lock:
+            return self._sizes.get((llm_provider, model, prompt_format), SIZES[0])
+
+    def report(self, llm_provider, model, prompt_format, size, passed):
+        """Record a response. Returns the size to retry with, or None."""
+        if passed:
+            return None
+        bigger = larger_size(size)
+        if bigger is None:
+            return None
+        key = (llm_provider, model, prompt_format)
+        with self._lock:
+            if SIZES.index(self._sizes.get(key, SIZES[0])) < SIZES.index(bigger):
+                self._sizes[key] = bigger
+        return bigger
+
+
+size_selector = SizeSelector()
@@ -0,0 +1,95 @@
+"""LRU cache of LLM responses, shared by the node and the sidecar.
+
+Keys cover everything that decides the answer (provider, model, host, both
+prompts, temperature and seed) and never the API key, so the same prompt
+enhanced with two keys is one entry. Identical requests that arrive while the
+first is still in flight wait for it instead of making a second call.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_TTL = 3600.0
+
+# Request fields that change the response. API keys are deliberately absent.
+KEY_FIELDS = ("provider", "model", "host", "system_prompt", "user_prompt", "temperature", "seed")
+
+
+def cache_key(request):
+    """Stable hash of the fields of ``request`` that decide the response."""
+    material = json.dumps([request.get(field) for field in KEY_FIELDS], ensure_ascii=False)
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """Thread-safe LRU with a time to live and in-flight request coalescing."""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires, value)
+        self._in_flight = {}           # key -> threading.Event
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            return self._get_locked(key)
+
+    def _get_locked(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_compute(self, key, compute):
+        """Return ``(value, cached)``, calling ``compute()`` at most once per key at a time."""
+        while True:
+            with self._lock:
+                value = self._get_locked(key)
+                if value is not None:
+                    self.hits += 1
+                    return value, True
+                waiter = self._in_flight.get(key)
+                if waiter is None:
+                    self.misses += 1
+                    done = self._in_flight[key] = threading.Event()
+                    break
+            # Someone else is computing this key. If they fail, try ourselves.
+            waiter.wait()
+        try:
+            value = compute()
+            if value:
+                self.put(key, value)
+            return value, False
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            done.set()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Per-process cache, used when no sidecar is running.
+cache = ResponseCache()
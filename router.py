@@ -0,0 +1,170 @@
+"""Picks a model per request when a model dropdown is set to ``auto``.
+
+A three word prompt does not need a flagship model. The router works out the
+lowest tier that suits the request from its length and ``prompt_format``, drops
+models that would cost more than the ceiling or do not fit the context window,
+and picks among the rest using live latency and error statistics. When no
+model of a suitable tier is under the ceiling, the ceiling wins: the cheapest
+priced model under it is used whatever its tier.
+
+Statistics are kept per (provider, model) in this process as exponentially
+weighted moving averages, so a model that starts timing out or erroring is
+avoided within a few calls and tried again once it recovers.
+"""
+
+import logging
+import threading
+
+try:
+    from . import models
+except ImportError:
+    import models
+
+logger = logging.getLogger('prompt_enhancer')
+
+# Rough size of a token in characters. Good enough for costing, no tokenizer needed.
+CHARS_PER_TOKEN = 4
+# Matches the max_tokens the providers are called with, unless the caller
+# passes the request's own.
+MAX_OUTPUT_TOKENS = 200
+
+# Prompt length in words (style instructions excluded) that moves a request up a tier.
+BALANCED_WORDS = 60
+FLAGSHIP_WORDS = 250
+
+# Weight of the newest sample in the moving averages.
+EWMA_ALPHA = 0.3
+# Models erroring more often than this are skipped while an alternative exists.
+MAX_ERROR_RATE = 0.5
+# Don't judge a model's error rate on fewer samples than this.
+MIN_SAMPLES = 3
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+def estimate_cost(info, input_tokens, output_tokens=MAX_OUTPUT_TOKENS):
+    """Worst case USD for one call, or None when the model has no published price."""
+    if info.input_price is None or info.output_price is None:
+        return None
+    return (input_tokens * info.input_price + output_tokens * info.output_price) / 1_000_000
+
+
+def required_tier(prompt, prompt_format):
+    """The cheapest tier that handles this request well."""
+    words = len(prompt.split())
+    if words >= FLAGSHIP_WORDS:
+        return "flagship"
+    # Tags need the model to pull every visual detail out of the description,
+    # which the smallest models start dropping on longer inputs.
+    if words >= BALANCED_WORDS or (prompt_format == "tags" and words >= BALANCED_WORDS // 2):
+        return "balanced"
+    return "fast"
+
+
+class ModelStats:
+    """Moving averages of latency and error rate per (provider, model)."""
+
+    def __init__(self, alpha=EWMA_ALPHA):
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _update(self, key, latency, error):
+        with self._lock:
+            entry = self._stats.get(key)
+            if entry is None:
+                self._stats[key] = {"latency": latency, "error_rate": float(error), "count": 1}
+                return
+            a = self.alpha
+            if latency is not None:
+                entry["latency"] = latency if entry["latency"] is None else a * latency + (1 - a) * entry["latency"]
+            entry["error_rate"] = a * float(error) + (1 - a) * entry["error_rate"]
+            entry["count"] += 1
+
+    def record(self, provider, model, latency):
+        self._update((provider, model), latency, False)
+
+    def record_error(self, provider, model):
+        self._update((provider, model), None, True)
+
+    def get(self, provider, model):
+        with self._lock:
+            entry = self._stats.get((provider, model))
+            return dict(entry) if entry else None
+
+
+stats = ModelStats()
+
+
+def candidates(provider, prompt, system_prompt, user_prompt, prompt_format, max_cost=0.0,
+               max_tokens=MAX_OUTPUT_TOKENS):
+    """Models worth considering, cheapest suitable tier first."""
+    infos = models.MODEL_INFO.get(provider, [])
+    input_tokens = estimate_tokens(system_prompt) + estimate_tokens(user_prompt)
+    floor = models.TIERS.index(required_tier(prompt, prompt_format))
+
+    eligible = []
+    for info in infos:
+        if models.TIERS.index(info.tier) > floor:
+            continue
+        if info.context is not None and input_tokens + max_tokens > info.context:
+            continue
+        if max_cost > 0:
+            cost = estimate_cost(info, input_tokens, max_tokens)
+            if cost is None or cost > max_cost:
+                continue
+        eligible.append(info)
+    # Least capable tier that qualifies first. Within a tier, cheaper first.
+    eligible.sort(key=lambda m: (-models.TIERS.index(m.tier), m.input_price is None, m.input_price or 0))
+    return eligible
+
+
+def cheapest_within(provider, system_prompt, user_prompt, max_cost, max_tokens=MAX_OUTPUT_TOKENS):
+    """The cheapest priced model under ``max_cost``, of any tier, or None."""
+    input_tokens = estimate_tokens(system_prompt) + estimate_tokens(user_prompt)
+    best, best_cost = None, None
+    for info in models.MODEL_INFO.get(provider, []):
+        if info.context is not None and input_tokens + max_tokens > info.context:
+            continue
+        cost = estimate_cost(info, input_tokens, max_tokens)
+        if cost is not None and cost <= max_cost and (best_cost is None or cost < best_cost):
+            best, best_cost = info, cost
+    return best
+
+
+def choose_model(provider, prompt, system_prompt, user_prompt, prompt_format, max_cost=0.0, model_stats=None,
+                 max_tokens=MAX_OUTPUT_TOKENS):
+    """Pick a model for one request, costed at ``max_tokens`` of output.
+
+    When nothing of the right tier fits ``max_cost``, the cheapest model that
+    does is used instead. Only when no priced model fits at all is the ceiling
+    dropped for the provider default.
+    """
+    model_stats = model_stats or stats
+    eligible = candidates(provider, prompt, system_prompt, user_prompt, prompt_format, max_cost, max_tokens)
+    if not eligible:
+        if max_cost > 0:
+            cheapest = cheapest_within(provider, system_prompt, user_prompt, max_cost, max_tokens)
+            if cheapest:
+                return cheapest.id
+            logger.warning(f"No {provider} model fits the ${max_cost:g} cost ceiling, "
+                           f"using {models.DEFAULTS.get(provider)} regardless")
+        return models.DEFAULTS.get(provider)
+
+    def healthy(info):
+        entry = model_stats.get(provider, info.id)
+        return not entry or entry["count"] < MIN_SAMPLES or entry["error_rate"] <= MAX_ERROR_RATE
+
+    pool = [info for info in eligible if healthy(info)] or eligible
+    best_tier = pool[0].tier
+    same_tier = [info for info in pool if info.tier == best_tier]
+
+    def latency(info):
+        entry = model_stats.get(provider, info.id)
+        # Untried models sort first so each one gets measured.
+        return entry["latency"] if entry and entry["latency"] is not None else 0.0
+
+    # Stable sort keeps the price order for models with equal latency.
+    return sorted(same_tier, key=latency)[0].id
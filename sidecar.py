@@ -0,0 +1,319 @@
+"""Optional enhancement daemon shared by every ComfyUI process on a host.
+
+Run it once per host:
+
+    python sidecar.py --port 8765 --rpm openai=500 --rpm anthropic=50
+
+then point each ComfyUI at it with ``PROMPT_ENHANCER_SIDECAR=http://127.0.0.1:8765``
+(or ``"sidecar_url"`` in ``config/llm_config.json``). The daemon owns what is
+worth sharing between processes:
+
+* one response cache, so a prompt is enhanced once per host, not once per process,
+* identical requests in flight at the same time collapse into one upstream call,
+* long-lived provider clients and HTTP connection pools,
+* per-provider rate limits, so many processes stay under one account's limit.
+
+The node checks for the daemon with a quick ``/health`` request, remembered for
+a short while. When it is not running, or stops answering, the node does the
+work in process exactly as before.
+
+Requests carry API keys, and Ollama requests name the server to call. By
+default the daemon only listens on loopback. To serve other machines, give it
+a shared ``--token`` (or ``PROMPT_ENHANCER_SIDECAR_TOKEN``), which it then
+requires on every request, and list any remote Ollama servers with
+``--ollama-host``. Other than those, it only calls Ollama on its own machine.
+"""
+
+import argparse
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+try:
+    from . import cancellation
+    from . import models
+    from . import response_cache
+    from . import router
+    from . import timeouts
+    from .ollama_residency import is_local_host
+except ImportError:
+    import cancellation
+    import models
+    import response_cache
+    import router
+    import timeouts
+    from ollama_residency import is_local_host
+
+logger = logging.getLogger('prompt_enhancer')
+
+SIDECAR_ENV = "PROMPT_ENHANCER_SIDECAR"
+TOKEN_ENV = "PROMPT_ENHANCER_SIDECAR_TOKEN"
+TOKEN_HEADER = "X-Prompt-Enhancer-Token"
+DEFAULT_PORT = 8765
+LOOPBACK_ADDRESSES = ("127.0.0.1", "localhost", "::1")
+
+# How long a health check result is trusted.
+HEALTH_TTL = 30.0
+HEALTH_TIMEOUT = 0.25
+# Extra time the node gives the sidecar on top of the provider timeout.
+TRANSPORT_SLACK = 5.0
+
+
+class SidecarUnavailable(Exception):
+    """The sidecar could not be reached. The caller should work in process."""
+
+
+class SidecarClient:
+    """Talks to a running sidecar, and remembers whether one is there."""
+
+    def __init__(self, url=None, token=None):
+        self.url = url.rstrip("/") if url else None
+        self._available = False
+        self._checked_at = None
+        self._session = requests.Session() if requests else None
+        if self._session and token:
+            self._session.headers[TOKEN_HEADER] = token
+
+    def available(self):
+        if not self.url or not self._session:
+            return False
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < HEALTH_TTL:
+            return self._available
+        try:
+            response = self._session.get(f"{self.url}/health", timeout=HEALTH_TIMEOUT)
+            self._available = response.status_code == 200
+        except requests.exceptions.RequestException:
+            self._available = False
+        if not self._available:
+            logger.info(f"Enhancement sidecar not reachable at {self.url}, working in process")
+        self._checked_at = now
+        return self._available
+
+    def _unavailable(self):
+        self._available = False
+        self._checked_at = time.monotonic()
+
+    def enhance(self, request, timeout=None, use_cache=True):
+        """Have the sidecar run ``request``. Returns the response text."""
+        payload = dict(request, timeout=timeout, use_cache=use_cache)
+        try:
+            response = self._session.post(
+                f"{self.url}/enhance", json=payload,
+                timeout=(timeout or cancellation.DEFAULT_TIMEOUT) + TRANSPORT_SLACK,
+            )
+        except requests.exceptions.RequestException as e:
+            self._unavailable()
+            raise SidecarUnavailable(str(e))
+        try:
+            data = response.json()
+        except ValueError:
+            data = None
+        # Anything but the sidecar's own JSON (a proxy's error page, a server
+        # that crashed mid-reply) means the sidecar is not really there
+        if not isinstance(data, dict) or (response.status_code >= 500 and "error" not in data):
+            self._unavailable()
+            raise SidecarUnavailable(f"HTTP {response.status_code} from {self.url}: {response.text[:200]}")
+        if response.status_code != 200:
+            raise RuntimeError(f"Sidecar: {data.get('error', response.text)}")
+        if data.get("latency") is not None:
+            # Upstream calls made by the sidecar still inform this process's
+            # router and timeouts
+            router.stats.record(request["provider"], request["model"], data["latency"])
+            timeouts.tracker.record(request["provider"], request["model"], request.get("host", ""),
+                                    data["latency"], data["text"])
+        return data["text"]
+
+
+_client = None
+
+
+def configure(url=None, token=None):
+    """Set the sidecar address and token. The environment variables win over the arguments."""
+    global _client
+    _client = SidecarClient(os.environ.get(SIDECAR_ENV) or url, os.environ.get(TOKEN_ENV) or token)
+    return _client
+
+
+def client():
+    return _client or configure()
+
+
+class RateLimiter:
+    """Token bucket per provider, in requests per minute."""
+
+    def __init__(self, rpm=None):
+        self.rpm = dict(rpm or {})
+        self._lock = threading.Lock()
+        self._buckets = {}  # provider -> (tokens, last refill)
+
+    def acquire(self, provider, timeout=None):
+        """Wait for a slot. Returns False if none frees up within ``timeout``."""
+        limit = self.rpm.get(provider)
+        if not limit:
+            return True
+        deadline = time.monotonic() + timeout if timeout else None
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                tokens, last = self._buckets.get(provider, (float(limit), now))
+                tokens = min(float(limit), tokens + (now - last) * limit / 60.0)
+                if tokens >= 1:
+                    self._buckets[provider] = (tokens - 1, now)
+                    return True
+                self._buckets[provider] = (tokens, now)
+                wait = (1 - tokens) * 60.0 / limit
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+
+class Sidecar:
+    """The daemon's state: one node instance, the shared cache and limits."""
+
+    def __init__(self, cache=None, limiter=None, token=None, ollama_hosts=()):
+        try:
+            from .prompt_enhancer_llm import PromptEnhancer
+        except ImportError:
+            from prompt_enhancer_llm import PromptEnhancer
+        self.enhancer = PromptEnhancer()
+        self.cache = cache or response_cache.ResponseCache()
+        self.limiter = limiter or RateLimiter()
+        self.token = token or None
+        self.ollama_hosts = {host.rstrip("/") for host in ollama_hosts}
+
+    def authorized(self, token):
+        """True when no token is set, or ``token`` is the one."""
+        if not self.token:
+            return True
+        return hmac.compare_digest((token or "").encode("utf-8"), self.token.encode("utf-8"))
+
+    def allows(self, request):
+        """True unless ``request`` is for an Ollama server off this machine that was not listed."""
+        if request.get("provider") != "ollama":
+            return True
+        host = (request.get("host") or "").strip() or models.OLLAMA_HOST_DEFAULT
+        return is_local_host(host) or host.rstrip("/") in self.ollama_hosts
+
+    def enhance(self, request):
+        """Returns ``(text, upstream latency or None when cached)``."""
+        timeout = request.get("timeout")
+        timings = {}
+
+        def upstream():
+            if not self.limiter.acquire(request["provider"], timeout):
+                raise RuntimeError(f"Rate limit for {request['provider']} not available within {timeout}s")
+            started = time.perf_counter()
+            text = self.enhancer._call_provider(request, timeout)
+            timings["latency"] = time.perf_counter() - started
+            return text
+
+        if not request.get("use_cache", True):
+            return upstream(), timings.get("latency")
+        text, _ = self.cache.get_or_compute(response_cache.cache_key(request), upstream)
+        return text, timings.get("latency")
+
+
+def make_handler(sidecar):
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, status, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _authorized(self):
+            if sidecar.authorized(self.headers.get(TOKEN_HEADER)):
+                return True
+            self._reply(401, {"error": "missing or wrong token"})
+            return False
+
+        def do_GET(self):
+            if not self._authorized():
+                return
+            if self.path != "/health":
+                return self._reply(404, {"error": "not found"})
+            self._reply(200, {
+                "ok": True,
+                "cache_entries": len(sidecar.cache),
+                "cache_hits": sidecar.cache.hits,
+                "cache_misses": sidecar.cache.misses,
+            })
+
+        def do_POST(self):
+            if not self._authorized():
+                return
+            if self.path != "/enhance":
+                return self._reply(404, {"error": "not found"})
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length))
+                if not sidecar.allows(request):
+                    return self._reply(403, {"error": f"Ollama host {request.get('host')} is not allowed"})
+                text, latency = sidecar.enhance(request)
+            except Exception as e:
+                logger.error(f"Sidecar request failed: {e}")
+                return self._reply(502, {"error": str(e)})
+            self._reply(200, {"text": text, "latency": latency})
+
+        def log_message(self, format, *args):
+            logger.debug("sidecar: " + format % args)
+
+    return Handler
+
+
+def parse_rpm(values):
+    """``["openai=500", "anthropic=50"]`` -> ``{"openai": 500.0, "anthropic": 50.0}``."""
+    rpm = {}
+    for value in values or []:
+        provider, _, limit = value.partition("=")
+        rpm[provider.strip()] = float(limit)
+    return rpm
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Shared prompt enhancement sidecar")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--cache-size", type=int, default=response_cache.DEFAULT_MAX_ENTRIES)
+    parser.add_argument("--cache-ttl", type=float, default=response_cache.DEFAULT_TTL)
+    parser.add_argument("--rpm", action="append", metavar="PROVIDER=N",
+                        help="Requests per minute for a provider. Repeat for each provider.")
+    parser.add_argument("--token", default=os.environ.get(TOKEN_ENV),
+                        help=f"Shared secret clients send in {TOKEN_HEADER}. Required off loopback.")
+    parser.add_argument("--ollama-host", action="append", default=[], metavar="URL",
+                        help="A remote Ollama server clients may use. Repeat for each server.")
+    args = parser.parse_args(argv)
+    if args.host not in LOOPBACK_ADDRESSES and not args.token:
+        parser.error(f"listening on {args.host} needs --token, since requests carry API keys")
+
+    logging.basicConfig(level=logging.INFO)
+    sidecar = Sidecar(
+        cache=response_cache.ResponseCache(args.cache_size, args.cache_ttl),
+        limiter=RateLimiter(parse_rpm(args.rpm)),
+        token=args.token,
+        ollama_hosts=args.ollama_host,
+    )
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(sidecar))
+    logger.info(f"Prompt enhancer sidecar listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
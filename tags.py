@@ -0,0 +1,103 @@
+"""Clean-up pass for ``tags`` format output.
+
+Models asked for tags still return duplicates, synonym stacks (``1girl, one
+girl, 1 girl``), underscores, stray quotes and ``Prompt:`` prefixes. Every
+wasted tag eats into CLIP's 77 token window, so the output goes through
+``clean_tags`` before it is encoded.
+
+Synonyms come from ``config/tag_vocabulary.json``, which maps each canonical
+tag to the spellings that should collapse into it. The bundled file sticks to
+spelling variants, since folding tags that differ in meaning changes the image. The file is loaded once
+into a flat dict keyed by the normalized spelling, so a lookup is a single
+hash probe per tag.
+"""
+
+import json
+import logging
+import os
+import re
+
+logger = logging.getLogger('prompt_enhancer')
+
+VOCABULARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config", "tag_vocabulary.json")
+
+# Commas, newlines and semicolons all show up as separators in model output.
+_SPLIT_RE = re.compile(r"[,\n;]+")
+# "(tag:1.2)" style weights. The weight survives canonicalization.
+_WEIGHT_RE = re.compile(r"^\((.+?):\s*([0-9]*\.?[0-9]+)\)$")
+_PREFIX_RE = re.compile(r"^(sdxl prompt|prompt|tags|output)\s*:\s*", re.IGNORECASE)
+_STRIP_CHARS = " \t\"'`*.-•"
+
+
+def normalize_tag(tag):
+    """Lowercase, turn underscores into spaces and squeeze whitespace."""
+    tag = tag.replace("_", " ").strip(_STRIP_CHARS).lower()
+    return " ".join(tag.split())
+
+
+class TagIndex:
+    """Hash index from any known spelling of a tag to its canonical form."""
+
+    def __init__(self, vocabulary=None):
+        self._canonical = {}
+        for canonical, synonyms in (vocabulary or {}).items():
+            self.add(canonical, synonyms)
+
+    def add(self, canonical, synonyms=()):
+        canonical = normalize_tag(canonical)
+        self._canonical[canonical] = canonical
+        for synonym in synonyms:
+            self._canonical[normalize_tag(synonym)] = canonical
+
+    def canonical(self, tag):
+        """Canonical spelling of an already normalized tag. Unknown tags pass through."""
+        return self._canonical.get(tag, tag)
+
+    def __len__(self):
+        return len(self._canonical)
+
+    @classmethod
+    def from_file(cls, path=VOCABULARY_PATH):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return cls(json.load(f))
+        except (OSError, ValueError) as e:
+            logger.error(f"Error loading tag vocabulary from {path}: {e}")
+            return cls()
+
+
+_default_index = None
+
+
+def default_index():
+    """The bundled vocabulary, loaded on first use."""
+    global _default_index
+    if _default_index is None:
+        _default_index = TagIndex.from_file()
+    return _default_index
+
+
+def clean_tags(text, index=None):
+    """Split, normalize, canonicalize and dedupe a comma separated tag prompt.
+
+    Order is preserved, and the first occurrence of a tag wins, so the tags
+    the model put first keep their place at the front of the CLIP window.
+    """
+    if index is None:
+        index = default_index()
+    text = _PREFIX_RE.sub("", text.strip())
+
+    seen = set()
+    cleaned = []
+    for raw in _SPLIT_RE.split(text):
+        raw = raw.strip(_STRIP_CHARS)
+        weight = None
+        match = _WEIGHT_RE.match(raw)
+        if match:
+            raw, weight = match.group(1), match.group(2)
+        tag = index.canonical(normalize_tag(raw))
+        if not tag or tag in seen:
+            continue
+        seen.add(tag)
+        cleaned.append(f"({tag}:{weight})" if weight else tag)
+    return ", ".join(cleaned)
@@ -7,12 +7,28 @@ run directly.
 Run with:  python3 test_prompt_enhancer.py
 """
 
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
 import unittest
 
 import models
+import ollama_residency
+import cancellation
+import key_pool
 import prompts
+import response_cache
+import router
+import sidecar
+import tags
+import timeouts
+import tracing
+import wildcards
 from prompts import get_system_prompt
-from prompt_enhancer_llm import PromptEnhancer
+from prompt_enhancer_llm import PromptEnhancer, ollama_timings
 
 
 class TestSystemPromptSelection(unittest.TestCase):
@@ -44,6 +60,31 @@ class TestSystemPromptSelection(unittest.TestCase):
         self.assertIn("comma-separated", prompts.TAG_SYSTEM_PROMPT)
         self.assertIn("SDXL", prompts.TAG_SYSTEM_PROMPT)
 
+    def test_every_size_exists_for_every_variant(self):
+        for prompt_format in ("descriptive", "tags"):
+            for provider in ("openai", "ollama"):
+                for size in prompts.SIZES:
+                    with self.subTest(format=prompt_format, provider=provider, size=size):
+                        self.assertTrue(get_system_prompt(prompt_format, provider, size))
+
+    def test_recorded_token_counts_are_current(self):
+        """Edit a prompt, then update SYSTEM_PROMPT_TOKENS with count_tokens."""
+        self.assertEqual(set(prompts.SYSTEM_PROMPT_TOKENS), set(prompts.SYSTEM_PROMPTS))
+        for key, text in prompts.SYSTEM_PROMPTS.items():
+            with self.subTest(variant=key):
+                self.assertEqual(prompts.SYSTEM_PROMPT_TOKENS[key], prompts.count_tokens(text))
+
+    def test_sizes_get_smaller(self):
+        for variant in ("descriptive", "ollama_descriptive", "tags"):
+            counts = [prompts.SYSTEM_PROMPT_TOKENS[(variant, size)] for size in prompts.SIZES]
+            with self.subTest(variant=variant):
+                self.assertEqual(counts, sorted(counts))
+
+    def test_small_ollama_prompts_keep_the_focus_object_rule(self):
+        for size in ("compact", "minimal"):
+            with self.subTest(size=size):
+                self.assertIn("focus object", get_system_prompt("descriptive", "ollama", size))
+
     def test_descriptive_prompts_are_distinct(self):
         self.assertNotEqual(
             prompts.DESCRIPTIVE_SYSTEM_PROMPT,
@@ -51,6 +92,70 @@ class TestSystemPromptSelection(unittest.TestCase):
         )
 
 
+class TestNegativePrompt(unittest.TestCase):
+    """One call returning both the positive and the negative prompt."""
+
+    def test_instructions_are_appended_per_format(self):
+        for prompt_format in ("descriptive", "tags"):
+            base = get_system_prompt(prompt_format, "openai")
+            extended = prompts.with_negative_instructions(base, prompt_format)
+            with self.subTest(format=prompt_format):
+                self.assertTrue(extended.startswith(base))
+                self.assertIn("NEGATIVE:", extended)
+
+    def test_split_labelled_response(self):
+        self.assertEqual(
+            prompts.split_negative("POSITIVE: (red car:1.2), night\nNEGATIVE: blurry, lowres"),
+            ("(red car:1.2), night", "blurry, lowres"),
+        )
+
+    def test_split_tolerates_markdown_labels(self):
+        self.assertEqual(
+            prompts.split_negative("**Positive prompt:** a red car\n\n**Negative:** blur"),
+            ("a red car", "blur"),
+        )
+
+    def test_unlabelled_response_is_all_positive(self):
+        self.assertEqual(prompts.split_negative("a red car at night"), ("a red car at night", ""))
+
+    def test_outputs_keep_existing_indices(self):
+        self.assertEqual(PromptEnhancer.RETURN_NAMES[:2], ("conditioning", "enhanced_prompt"))
+        self.assertEqual(len(PromptEnhancer.RETURN_TYPES), len(PromptEnhancer.OUTPUT_IS_LIST))
+
+
+class TestSystemPromptSizing(unittest.TestCase):
+    """Output checks and the auto size selector."""
+
+    def test_good_tags_pass(self):
+        self.assertTrue(prompts.check_output("tags", "masterpiece, 1girl, solo, red dress, forest"))
+
+    def test_prose_and_preambles_fail_the_tag_check(self):
+        for text in (
+            "Here are your tags: 1girl, solo, forest",
+            "A girl in a red dress stands alone in a quiet forest at dawn.",
+            "1girl, solo, she is standing in the middle of a forest at dawn looking sad",
+            "- 1girl\n- solo\n- forest",
+        ):
+            with self.subTest(text=text):
+                self.assertFalse(prompts.check_output("tags", text))
+
+    def test_descriptive_check(self):
+        self.assertTrue(prompts.check_output("descriptive", "A red car on a wet street at night. Neon signs glow."))
+        self.assertFalse(prompts.check_output("descriptive", "**Prompt:** a red car"))
+        self.assertFalse(prompts.check_output("descriptive", ""))
+
+    def test_selector_starts_small_and_moves_up_on_failure(self):
+        selector = prompts.SizeSelector()
+        self.assertEqual(selector.choose("ollama", "llama3.2:1b", "tags"), "minimal")
+        self.assertIsNone(selector.report("ollama", "llama3.2:1b", "tags", "minimal", True))
+        self.assertEqual(selector.report("ollama", "llama3.2:1b", "tags", "minimal", False), "compact")
+        self.assertEqual(selector.choose("ollama", "llama3.2:1b", "tags"), "compact")
+        self.assertEqual(selector.report("ollama", "llama3.2:1b", "tags", "compact", False), "full")
+        self.assertIsNone(selector.report("ollama", "llama3.2:1b", "tags", "full", False))
+        # Other models are unaffected
+        self.assertEqual(selector.choose("ollama", "qwen2.5:1.5b", "tags"), "minimal")
+
+
 class TestModelLists(unittest.TestCase):
     """Model lists and defaults have to agree with each other."""
 
@@ -70,6 +175,15 @@ class TestModelLists(unittest.TestCase):
                 self.assertEqual(len(choices), len(set(choices)))
                 self.assertTrue(all(m and m.strip() for m in choices))
 
+    def test_model_info_is_complete(self):
+        for provider, infos in models.MODEL_INFO.items():
+            for info in infos:
+                with self.subTest(model=info.id):
+                    self.assertIn(info.tier, models.TIERS)
+                    self.assertEqual(info.input_price is None, info.output_price is None)
+            with self.subTest(provider=provider):
+                self.assertIn(models.DEFAULTS[provider], [m.id for m in infos])
+
     def test_retired_model_ids_are_gone(self):
         """These all 404 now. Guard against anyone pasting them back in."""
         retired = [
@@ -121,7 +235,7 @@ class TestInputTypes(unittest.TestCase):
         for name, choices, default in cases:
             with self.subTest(input=name):
                 spec_choices, config = self.spec["optional"][name]
-                self.assertEqual(spec_choices, choices)
+                self.assertEqual(spec_choices, [models.AUTO_MODEL] + choices)
                 self.assertEqual(config["default"], default)
 
     def test_openrouter_default_is_a_live_free_model(self):
@@ -130,6 +244,28 @@ class TestInputTypes(unittest.TestCase):
         self.assertTrue(config["default"].endswith(":free"))
 
 
+class TestIsChanged(unittest.TestCase):
+    """ComfyUI skips the node on re-queue when IS_CHANGED returns the same value."""
+
+    INPUTS = {"prompt": "a red car", "llm_provider": "openai", "style": "Basic Styles > none",
+              "openai_key": "sk-one", "seed": 1, "temperature": 0.7}
+
+    def test_same_inputs_same_hash(self):
+        self.assertEqual(PromptEnhancer.IS_CHANGED(**self.INPUTS), PromptEnhancer.IS_CHANGED(**self.INPUTS))
+
+    def test_new_seed_rerolls(self):
+        self.assertNotEqual(PromptEnhancer.IS_CHANGED(**self.INPUTS),
+                            PromptEnhancer.IS_CHANGED(**dict(self.INPUTS, seed=2)))
+
+    def test_api_key_does_not_matter(self):
+        self.assertEqual(PromptEnhancer.IS_CHANGED(**self.INPUTS),
+                         PromptEnhancer.IS_CHANGED(**dict(self.INPUTS, openai_key="sk-two")))
+
+    def test_cache_off_always_runs(self):
+        value = PromptEnhancer.IS_CHANGED(use_cache=False, **self.INPUTS)
+        self.assertNotEqual(value, value)  # NaN never equals itself
+
+
 class TestBackwardCompatibility(unittest.TestCase):
     """An old workflow calls enhance_prompt without any of the new inputs."""
 
@@ -142,6 +278,17 @@ class TestBackwardCompatibility(unittest.TestCase):
             "openai_model",
             "anthropic_model",
             "google_model",
+            "ollama_keep_alive",
+            "clean_tags",
+            "trace",
+            "max_cost_per_call",
+            "system_prompt_size",
+            "use_cache",
+            "generate_negative",
+            "seed",
+            "temperature",
+            "expand_wildcards",
+            "max_variants",
         ]
         for name in new_inputs:
             with self.subTest(param=name):
@@ -152,14 +299,34 @@ class TestBackwardCompatibility(unittest.TestCase):
         """The one path that needs no API key and no CLIP work."""
         node = PromptEnhancer()
         sentinel_clip = object()
-        clip_out, text_out = node.enhance_prompt(
+        clip_out, text_out, _, negative_out = node.enhance_prompt(
             clip=sentinel_clip,
             prompt="a red bicycle",
             llm_provider="none",
             style="Basic Styles > none",
         )
-        self.assertIs(clip_out, sentinel_clip)
-        self.assertEqual(text_out, "a red bicycle")
+        self.assertEqual(len(clip_out), 1)
+        self.assertIs(clip_out[0], sentinel_clip)
+        self.assertEqual(text_out, ["a red bicycle"])
+        self.assertEqual(negative_out, [""])
+
+    def test_async_entry_point_matches_sync(self):
+        node = PromptEnhancer()
+        sentinel_clip = object()
+        clip_out, text_out, _, negative_out = asyncio.run(node.enhance_prompt_async(
+            clip=sentinel_clip,
+            prompt="a red bicycle",
+            llm_provider="none",
+            style="Basic Styles > none",
+        ))
+        self.assertEqual(len(clip_out), 1)
+        self.assertIs(clip_out[0], sentinel_clip)
+        self.assertEqual(text_out, ["a red bicycle"])
+        self.assertEqual(negative_out, [""])
+
+    def test_sync_function_outside_async_comfyui(self):
+        """Older ComfyUI would get a coroutine back instead of outputs."""
+        self.assertEqual(PromptEnhancer.FUNCTION, "enhance_prompt")
 
 
 class TestStyleHandling(unittest.TestCase):
@@ -178,5 +345,821 @@ class TestStyleHandling(unittest.TestCase):
                 self.assertIn(style, self.node.style_prompts)
 
 
+class TestOllamaResidency(unittest.TestCase):
+    """Helpers behind the Ollama warm-up manager."""
+
+    def test_local_hosts_are_recognised(self):
+        for host in ("http://localhost:11434", "http://127.0.0.1:11434", "http://[::1]:11434"):
+            with self.subTest(host=host):
+                self.assertTrue(ollama_residency.is_local_host(host))
+
+    def test_remote_hosts_are_not_unloaded(self):
+        for host in ("http://gpu-box:11434", "https://ollama.example.com", "not a url"):
+            with self.subTest(host=host):
+                self.assertFalse(ollama_residency.is_local_host(host))
+
+    def test_parse_loaded_models_reads_ps_payload(self):
+        payload = {"models": [{"name": "llama3.2:1b", "model": "llama3.2:1b"}, {"model": "gemma2:2b"}]}
+        self.assertEqual(
+            ollama_residency.parse_loaded_models(payload),
+            {"llama3.2:1b", "gemma2:2b"},
+        )
+        self.assertEqual(ollama_residency.parse_loaded_models({}), set())
+
+    def test_preload_only_reaches_local_or_known_hosts(self):
+        residency = ollama_residency.OllamaResidency()
+        self.assertTrue(residency.allows("http://localhost:11434"))
+        for host in ("http://169.254.169.254", "http://gpu-box:11434", "file:///etc/passwd", "not a url"):
+            with self.subTest(host=host):
+                self.assertFalse(residency.allows(host))
+        residency.track("http://gpu-box:11434", "llama3.2:1b")
+        self.assertTrue(residency.allows("http://gpu-box:11434/"))
+
+    def test_timings_split_prompt_eval_from_generation(self):
+        final = {"done": True, "total_duration": 1_900_000_000, "load_duration": 10_000_000,
+                 "prompt_eval_count": 12, "prompt_eval_duration": 90_000_000,
+                 "eval_count": 60, "eval_duration": 1_500_000_000}
+        timings = ollama_timings(final, first_token=0.1234)
+        self.assertEqual(timings["prompt_eval"], 0.09)
+        self.assertEqual(timings["eval"], 1.5)
+        self.assertEqual(timings["prompt_eval_count"], 12)
+        self.assertEqual(timings["tokens_per_second"], 40.0)
+        self.assertEqual(timings["first_token"], 0.123)
+        self.assertEqual(ollama_timings({}), {})
+
+    def test_mark_loaded_counts_as_resident(self):
+        residency = ollama_residency.OllamaResidency()
+        residency.mark_loaded("http://localhost:11434", "llama3.2:1b")
+        self.assertTrue(residency.is_loaded("http://localhost:11434", "llama3.2:1b"))
+
+
+class OllamaStub:
+    """A local stand-in for an Ollama server that records what it is sent.
+
+    ``chat=False`` answers /api/chat with a bare 404, like Ollama from before
+    the endpoint existed. ``load_delay`` is how long the first generation
+    takes, as if the model were loading. A user prompt containing ``stall``
+    takes two seconds.
+    """
+
+    def __init__(self, test, reply="a red car at dawn", chat=True, models=("llama3.2:1b",), load_delay=0.0,
+                 stall=None):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        stub = self
+        self.requests = []  # (path, JSON body)
+        self.load_delay = load_delay
+
+        class Handler(BaseHTTPRequestHandler):
+            def _send(self, status, body):
+                data = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._send(200, {"models": []})
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                stub.requests.append((self.path, body))
+                if self.path == "/api/show":
+                    if body.get("model") in models:
+                        return self._send(200, {"details": {}})
+                    return self._send(404, {"error": f"model '{body.get('model')}' not found"})
+                if self.path == "/api/chat" and not chat:
+                    return self._send(404, b"404 page not found")
+                if self.path not in ("/api/chat", "/api/generate"):
+                    return self._send(404, b"404 page not found")
+                time.sleep(stub.load_delay)
+                stub.load_delay = 0.0
+                user_prompt = body["messages"][-1]["content"] if "messages" in body else body["prompt"]
+                if stall and stall in user_prompt:
+                    time.sleep(2.0)
+                lines = []
+                for word in reply.split(" "):
+                    text = word + " "
+                    chunk = {"message": {"role": "assistant", "content": text}} if self.path == "/api/chat" \
+                        else {"response": text}
+                    lines.append(dict(chunk, done=False))
+                lines.append({"done": True, "prompt_eval_count": 12, "prompt_eval_duration": 90_000_000,
+                              "eval_count": 5, "eval_duration": 250_000_000})
+                self._send(200, "".join(json.dumps(line) + "\n" for line in lines).encode("utf-8"))
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        test.addCleanup(self.server.server_close)
+        test.addCleanup(self.server.shutdown)
+        self.host = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def paths(self):
+        return [path for path, _ in self.requests]
+
+
+class TestOllamaCalls(unittest.TestCase):
+    """The node's Ollama requests, against a stub server."""
+
+    def setUp(self):
+        self.node = PromptEnhancer()
+
+    def enhance(self, stub, model="llama3.2:1b", timeout=10, system="SYSTEM PROMPT", user="detailed a red car",
+                **kwargs):
+        return self.node._enhance_ollama(system, user, stub.host, model, "5m", timeout, **kwargs)
+
+    def test_chat_sends_the_system_prompt_as_its_own_message(self):
+        stub = OllamaStub(self)
+        self.assertEqual(self.enhance(stub, temperature=0.3, seed=7), "a red car at dawn")
+        path, body = stub.requests[-1]
+        self.assertEqual(path, "/api/chat")
+        self.assertEqual(body["messages"], [{"role": "system", "content": "SYSTEM PROMPT"},
+                                            {"role": "user", "content": "detailed a red car"}])
+        self.assertTrue(body["stream"])
+        self.assertEqual(body["keep_alive"], "5m")
+        self.assertEqual(body["options"], {"temperature": 0.3, "seed": 7})
+        self.assertNotIn("system", body)
+        self.assertNotIn("prompt", body)
+
+    def test_system_prompt_is_a_stable_prefix(self):
+        # The KV cache only helps if the system message is identical from call
+        # to call, whatever the style
+        system = get_system_prompt("descriptive", "ollama")
+        self.assertEqual(system, get_system_prompt("descriptive", "ollama"))
+        stub = OllamaStub(self)
+        for style in ("cinematic", "anime"):
+            with self.subTest(style=style):
+                self.assertNotIn(self.node.style_prompts[style], system)
+                self.enhance(stub, system=system, user=f"{self.node.style_prompts[style]}\n\na red car")
+        sent = [body["messages"][0] for path, body in stub.requests if path == "/api/chat"]
+        self.assertEqual(sent, [{"role": "system", "content": system}] * 2)
+
+    def test_servers_without_chat_get_generate_with_a_system_field(self):
+        stub = OllamaStub(self, chat=False)
+        self.assertEqual(self.enhance(stub), "a red car at dawn")
+        self.assertEqual(stub.paths(), ["/api/show", "/api/chat", "/api/generate"])
+        body = stub.requests[-1][1]
+        self.assertEqual(body["system"], "SYSTEM PROMPT")
+        self.assertEqual(body["prompt"], "detailed a red car")
+        self.assertNotIn("messages", body)
+        # The server is remembered, so the next call goes straight to generate
+        self.assertEqual(self.enhance(stub), "a red car at dawn")
+        self.assertEqual(stub.paths()[-1], "/api/generate")
+        self.assertEqual(stub.paths().count("/api/chat"), 1)
+
+    def test_probe_does_not_load_the_model(self):
+        # A load longer than the old 5 second probe limit still gets enhanced,
+        # because only the real call waits for the load
+        stub = OllamaStub(self, load_delay=0.5)
+        self.assertEqual(self.enhance(stub), "a red car at dawn")
+        self.assertEqual(stub.paths()[0], "/api/show")
+        self.assertNotIn("/api/generate", stub.paths())
+
+    def test_a_stalled_variant_times_out_alone(self):
+        stub = OllamaStub(self, stall="slow")
+        request = {"provider": "ollama", "model": "llama3.2:1b", "system_prompt": "SYSTEM PROMPT",
+                   "api_key": "", "host": stub.host, "keep_alive": "5m", "max_tokens": 200,
+                   "temperature": 0.7, "seed": 0}
+        batch = [dict(request, user_prompt=f"{word} car") for word in ("red", "slow", "blue")]
+        responses = cancellation.run_interruptible(*self.node._batch_step(batch, 0.5, use_cache=False))
+        self.assertEqual(responses[0], "a red car at dawn")
+        self.assertIsInstance(responses[1], cancellation.CallTimeout)
+        self.assertEqual(responses[2], "a red car at dawn")
+
+    def test_missing_model_is_reported(self):
+        stub = OllamaStub(self)
+        with self.assertRaisesRegex(ValueError, "ollama pull nope"):
+            self.enhance(stub, model="nope")
+        self.assertEqual(stub.paths(), ["/api/show"])
+
+
+class TestTagCleanup(unittest.TestCase):
+    """clean_tags against the bundled vocabulary."""
+
+    def test_duplicates_and_synonyms_collapse(self):
+        result = tags.clean_tags("1girl, one girl, Solo, solo, blond hair, blonde_hair, close up, closeup")
+        self.assertEqual(result, "1girl, solo, blonde hair, close-up")
+
+    def test_order_is_preserved(self):
+        self.assertEqual(tags.clean_tags("forest, 1girl, forest"), "forest, 1girl")
+
+    def test_weights_survive_canonicalization(self):
+        self.assertEqual(
+            tags.clean_tags("(Rim-Lighting:1.2), rim lighting"),
+            "(rim lighting:1.2)",
+        )
+
+    def test_junk_is_stripped(self):
+        result = tags.clean_tags('Prompt: "masterpiece", best quality,\n, ,highly detailed.')
+        self.assertEqual(result, "masterpiece, best quality, highly detailed")
+
+    def test_bundled_vocabulary_keeps_tags_that_differ_in_meaning(self):
+        # Dark hair is often brown, light rays is a tag of its own, and
+        # checkpoints weight the quality tags differently
+        result = tags.clean_tags("dark hair, cloudy sky, light rays, high quality, best quality")
+        self.assertEqual(result, "dark hair, cloudy sky, light rays, high quality, best quality")
+
+    def test_custom_vocabulary(self):
+        index = tags.TagIndex({"cat": ["kitty", "Kitten_Cat"]})
+        self.assertEqual(tags.clean_tags("kitty, kitten cat, cat", index), "cat")
+
+    def test_bundled_vocabulary_loads(self):
+        self.assertGreater(len(tags.default_index()), 0)
+
+
+class TestTracing(unittest.TestCase):
+    """Span tracing is free when off and writes Chrome JSON when on."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self._old_dir = os.environ.get(tracing.TRACE_DIR_ENV)
+        os.environ[tracing.TRACE_DIR_ENV] = self.tmp.name
+        self.addCleanup(self._restore_dir)
+
+    def _restore_dir(self):
+        if self._old_dir is None:
+            os.environ.pop(tracing.TRACE_DIR_ENV, None)
+        else:
+            os.environ[tracing.TRACE_DIR_ENV] = self._old_dir
+
+    def test_span_outside_a_run_is_the_shared_no_op(self):
+        self.assertIs(tracing.span("request"), tracing._NULL_SPAN)
+        with tracing.run("disabled") as trace:
+            self.assertIsNone(trace)
+            self.assertIs(tracing.span("request"), tracing._NULL_SPAN)
+        self.assertEqual(os.listdir(self.tmp.name), [])
+
+    def test_enabled_run_writes_chrome_trace(self):
+        with tracing.run("enhance_prompt (ollama)", enabled=True):
+            with tracing.span("request", provider="ollama"):
+                pass
+        files = os.listdir(self.tmp.name)
+        self.assertEqual(len(files), 1)
+        with open(os.path.join(self.tmp.name, files[0])) as f:
+            data = json.load(f)
+        names = [event["name"] for event in data["traceEvents"]]
+        self.assertEqual(names, ["request", "enhance_prompt (ollama)"])
+        self.assertTrue(all(event["ph"] == "X" for event in data["traceEvents"]))
+        self.assertEqual(data["traceEvents"][0]["args"], {"provider": "ollama"})
+
+    def test_failed_span_records_the_error(self):
+        with tracing.run("run", enabled=True) as trace:
+            with self.assertRaises(ValueError):
+                with tracing.span("parse"):
+                    raise ValueError("bad json")
+        self.assertEqual(trace.events[0]["args"]["error"], "ValueError")
+
+    def test_profile_covers_the_helper_thread_but_not_the_awaits(self):
+        import pstats
+        os.environ[tracing.PROFILE_ENV] = "1"
+        tracing._profile_runs_left = None
+        self.addCleanup(os.environ.pop, tracing.PROFILE_ENV, None)
+        self.addCleanup(setattr, tracing, "_profile_runs_left", None)
+
+        def helper_thread_work():
+            time.sleep(0.1)
+            return "done"
+
+        def event_loop_work():
+            return sum(range(100))
+
+        def steps():
+            with tracing.run("profiled"):
+                value = yield helper_thread_work, 5
+            return value
+
+        async def main():
+            async def meanwhile():
+                await asyncio.sleep(0.02)
+                event_loop_work()
+            other = asyncio.ensure_future(meanwhile())
+            value = await cancellation.drive_async(steps())
+            await other
+            return value
+
+        self.assertEqual(asyncio.run(main()), "done")
+        [path] = [name for name in os.listdir(self.tmp.name) if name.endswith(".pstats")]
+        functions = {function for _, _, function in pstats.Stats(os.path.join(self.tmp.name, path)).stats}
+        self.assertIn("helper_thread_work", functions)
+        self.assertNotIn("event_loop_work", functions)
+
+
+class TestModelRouter(unittest.TestCase):
+    """Auto model selection."""
+
+    def choose(self, provider, prompt, prompt_format="descriptive", max_cost=0.0, model_stats=None):
+        system_prompt = get_system_prompt(prompt_format, provider)
+        return router.choose_model(provider, prompt, system_prompt, prompt, prompt_format, max_cost,
+                                   model_stats or router.ModelStats())
+
+    def test_short_prompt_gets_the_cheap_tier(self):
+        self.assertEqual(self.choose("openai", "a red car"), "gpt-5.6-luna")
+        self.assertEqual(self.choose("anthropic", "a red car"), "claude-haiku-4-5")
+
+    def test_long_prompt_moves_up_a_tier(self):
+        prompt = " ".join(["word"] * router.BALANCED_WORDS)
+        self.assertEqual(self.choose("openai", prompt), "gpt-5.6-terra")
+
+    def test_tags_move_up_sooner(self):
+        prompt = " ".join(["word"] * (router.BALANCED_WORDS // 2))
+        self.assertEqual(self.choose("openai", prompt), "gpt-5.6-luna")
+        self.assertEqual(self.choose("openai", prompt, "tags"), "gpt-5.6-terra")
+
+    def test_cost_ceiling_skips_unpriced_and_expensive_models(self):
+        self.assertEqual(self.choose("google", "a red car", max_cost=0.01), "gemini-3.1-flash-lite")
+        prompt = " ".join(["word"] * router.FLAGSHIP_WORDS)
+        # No flagship fits, so the ceiling wins over the tier
+        self.assertEqual(self.choose("openai", prompt, max_cost=0.001), "gpt-5.6-luna")
+        self.assertEqual(self.choose("google", prompt, max_cost=0.01), "gemini-3.1-flash-lite")
+        # Nothing at all fits, so the ceiling is dropped, with a warning
+        with self.assertLogs("prompt_enhancer", "WARNING"):
+            self.assertEqual(self.choose("openai", prompt, max_cost=0.000001), models.OPENAI_DEFAULT)
+
+    def test_negative_prompts_are_costed_at_their_own_output(self):
+        plain = get_system_prompt("descriptive", "openai")
+        with_negative = prompts.with_negative_instructions(plain, "descriptive")
+        fits = router.candidates("openai", "a red car", plain, "a red car", "descriptive", 0.0003)
+        self.assertIn("gpt-5.6-luna", [info.id for info in fits])
+        # Twice the output and the longer system prompt take it over the ceiling
+        self.assertEqual(router.candidates("openai", "a red car", with_negative, "a red car", "descriptive",
+                                           0.0003, max_tokens=400), [])
+        self.assertIsNone(router.cheapest_within("openai", with_negative, "a red car", 0.0003, max_tokens=400))
+
+    def test_failing_model_is_avoided(self):
+        model_stats = router.ModelStats()
+        for _ in range(router.MIN_SAMPLES):
+            model_stats.record_error("google", "gemini-3.5-flash-lite")
+        model_stats.record("google", "gemini-3.1-flash-lite", 0.4)
+        self.assertEqual(self.choose("google", "a red car", model_stats=model_stats), "gemini-3.1-flash-lite")
+
+    def test_faster_model_wins_within_a_tier(self):
+        model_stats = router.ModelStats()
+        model_stats.record("google", "gemini-3.5-flash-lite", 0.3)
+        model_stats.record("google", "gemini-3.1-flash-lite", 0.9)
+        self.assertEqual(self.choose("google", "a red car", model_stats=model_stats), "gemini-3.5-flash-lite")
+
+
+class TestCancellation(unittest.TestCase):
+    """Deadlines stop the wait without waiting for the call itself."""
+
+    def test_result_and_errors_pass_through(self):
+        self.assertEqual(cancellation.run_interruptible(lambda: "ok", timeout=1), "ok")
+        with self.assertRaises(KeyError):
+            cancellation.run_interruptible(lambda: {}["missing"], timeout=1)
+
+    def test_deadline_aborts_a_slow_call(self):
+        aborted = threading.Event()
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def slow_call():
+            cancellation.on_abort(aborted.set)
+            release.wait(5)
+            return cancellation.cancel_requested()
+
+        started = time.monotonic()
+        with self.assertRaises(cancellation.CallTimeout):
+            cancellation.run_interruptible(slow_call, timeout=0.1)
+        self.assertLess(time.monotonic() - started, 1.0)
+        self.assertTrue(aborted.is_set())
+
+    def test_drive_feeds_results_back_into_the_steps(self):
+        def steps():
+            first = yield (lambda: 2, 1)
+            try:
+                yield (lambda: 1 / 0, 1)
+            except ZeroDivisionError:
+                pass
+            return first * 10
+
+        self.assertEqual(cancellation.drive(steps()), 20)
+        self.assertEqual(asyncio.run(cancellation.drive_async(steps())), 20)
+
+    def test_ollama_keeps_its_tighter_timeout(self):
+        self.assertEqual(cancellation.timeout_for("ollama"), 30.0)
+        self.assertEqual(cancellation.timeout_for("openai"), cancellation.DEFAULT_TIMEOUT)
+
+
+class TestResponseCache(unittest.TestCase):
+    """The LRU shared by the node and the sidecar."""
+
+    REQUEST = {"provider": "openai", "model": "gpt-5.6-luna", "host": "",
+               "system_prompt": "sys", "user_prompt": "a red car", "api_key": "sk-one"}
+
+    def test_key_ignores_the_api_key(self):
+        other_key = dict(self.REQUEST, api_key="sk-two")
+        self.assertEqual(response_cache.cache_key(self.REQUEST), response_cache.cache_key(other_key))
+        other_model = dict(self.REQUEST, model="gpt-5.6-sol")
+        self.assertNotEqual(response_cache.cache_key(self.REQUEST), response_cache.cache_key(other_model))
+
+    def test_key_covers_seed_and_temperature(self):
+        # Otherwise a reroll would be answered from the cache
+        for field, value in (("seed", 42), ("temperature", 0.0)):
+            with self.subTest(field=field):
+                changed = dict(self.REQUEST, **{field: value})
+                self.assertNotEqual(response_cache.cache_key(self.REQUEST), response_cache.cache_key(changed))
+
+    def test_lru_evicts_oldest(self):
+        cache = response_cache.ResponseCache(max_entries=2)
+        cache.put("a", "1")
+        cache.put("b", "2")
+        cache.get("a")
+        cache.put("c", "3")
+        self.assertEqual(cache.get("a"), "1")
+        self.assertIsNone(cache.get("b"))
+
+    def test_expired_entries_are_misses(self):
+        cache = response_cache.ResponseCache(ttl=-1)
+        cache.put("a", "1")
+        self.assertIsNone(cache.get("a"))
+
+    def test_concurrent_identical_requests_share_one_call(self):
+        cache = response_cache.ResponseCache()
+        calls = []
+        release = threading.Event()
+
+        def compute():
+            calls.append(1)
+            release.wait(2)
+            return "enhanced"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_compute("k", compute)))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join(2)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(cached for _, cached in results), [False, True, True, True])
+
+
+class TestSidecar(unittest.TestCase):
+    """The daemon's HTTP interface and its rate limiter."""
+
+    def test_client_without_url_is_never_available(self):
+        self.assertFalse(sidecar.SidecarClient(None).available())
+
+    def test_parse_rpm(self):
+        self.assertEqual(sidecar.parse_rpm(["openai=500", " anthropic = 50"]), {"openai": 500.0, "anthropic": 50.0})
+
+    def test_rate_limiter_gives_up_past_its_timeout(self):
+        limiter = sidecar.RateLimiter({"openai": 1})
+        self.assertTrue(limiter.acquire("openai", timeout=0.1))
+        self.assertFalse(limiter.acquire("openai", timeout=0.1))
+        self.assertTrue(limiter.acquire("anthropic", timeout=0.1))
+
+    def test_health_and_error_responses(self):
+        from http.server import ThreadingHTTPServer
+        from urllib.error import HTTPError
+        from urllib.request import Request, urlopen
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), sidecar.make_handler(sidecar.Sidecar()))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+
+        with urlopen(f"{url}/health", timeout=2) as response:
+            self.assertTrue(json.load(response)["ok"])
+
+        body = json.dumps({"provider": "nope", "model": "x", "system_prompt": "s", "user_prompt": "u"})
+        request = Request(f"{url}/enhance", data=body.encode(), headers={"Content-Type": "application/json"})
+        with self.assertRaises(HTTPError) as raised:
+            urlopen(request, timeout=2)
+        self.assertEqual(raised.exception.code, 502)
+        self.assertIn("Unknown provider", json.load(raised.exception)["error"])
+
+    def test_token_and_ollama_hosts_are_enforced(self):
+        from http.server import ThreadingHTTPServer
+
+        daemon = sidecar.Sidecar(token="s3cret", ollama_hosts=["http://gpu-box:11434/"])
+        server = ThreadingHTTPServer(("127.0.0.1", 0), sidecar.make_handler(daemon))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+
+        self.assertFalse(sidecar.SidecarClient(url).available())
+        self.assertFalse(sidecar.SidecarClient(url, token="wrong").available())
+        client = sidecar.SidecarClient(url, token="s3cret")
+        self.assertTrue(client.available())
+
+        request = {"provider": "ollama", "model": "x", "system_prompt": "s", "user_prompt": "u",
+                   "host": "http://169.254.169.254"}
+        with self.assertRaisesRegex(RuntimeError, "not allowed"):
+            client.enhance(request, timeout=2)
+        self.assertTrue(daemon.allows(dict(request, host="http://gpu-box:11434")))
+        self.assertTrue(daemon.allows(dict(request, host="")))
+
+    def test_listening_off_loopback_needs_a_token(self):
+        with self.assertRaises(SystemExit):
+            sidecar.main(["--host", "0.0.0.0"])
+
+    def test_non_json_replies_mean_the_sidecar_is_unavailable(self):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        replies = {"/enhance": (502, b"<html>Bad Gateway</html>")}
+
+        class Proxy(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                status, body = replies["/enhance"]
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Proxy)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        client = sidecar.SidecarClient(f"http://127.0.0.1:{server.server_address[1]}")
+        request = {"provider": "openai", "model": "x", "system_prompt": "s", "user_prompt": "u"}
+
+        for reply in [(502, b"<html>Bad Gateway</html>"), (500, b'{"detail": "crashed"}'), (200, b"not json")]:
+            with self.subTest(reply=reply):
+                replies["/enhance"] = reply
+                with self.assertRaises(sidecar.SidecarUnavailable):
+                    client.enhance(request, timeout=2)
+        # The sidecar's own errors still surface as errors
+        replies["/enhance"] = (502, b'{"error": "Unknown provider"}')
+        with self.assertRaisesRegex(RuntimeError, "Unknown provider"):
+            client.enhance(request, timeout=2)
+
+
+class TestAdaptiveTimeouts(unittest.TestCase):
+    """Timeouts sized from observed latency."""
+
+    def setUp(self):
+        self.tracker = timeouts.LatencyTracker(multiplier=3.0, min_timeout=5.0, max_timeout=180.0)
+
+    def fill(self, latency, text="word " * 50, provider="ollama", model="llama3.2:1b", host="http://localhost:11434"):
+        for _ in range(timeouts.MIN_SAMPLES):
+            self.tracker.record(provider, model, host, latency, text)
+
+    def test_percentile(self):
+        self.assertEqual(timeouts.percentile(list(range(1, 101)), 0.95), 95)
+        self.assertEqual(timeouts.percentile([4.0], 0.95), 4.0)
+        self.assertIsNone(timeouts.percentile([], 0.95))
+
+    def test_static_default_until_enough_samples(self):
+        self.tracker.record("ollama", "llama3.2:1b", "http://localhost:11434", 1.0, "a red car")
+        self.assertEqual(self.tracker.timeout_for("ollama", "llama3.2:1b", "http://localhost:11434"),
+                         cancellation.timeout_for("ollama"))
+
+    def test_fast_endpoint_gets_a_short_timeout(self):
+        self.fill(0.5)
+        self.assertEqual(self.tracker.timeout_for("ollama", "llama3.2:1b", "http://localhost:11434", 50), 5.0)
+
+    def test_slow_but_healthy_model_is_not_cut_off(self):
+        # 40 seconds for 50 tokens: the old fixed 30 seconds would have killed it
+        self.fill(40.0)
+        timeout = self.tracker.timeout_for("ollama", "llama3.2:1b", "http://localhost:11434", 50)
+        self.assertGreater(timeout, 40.0)
+        self.assertLessEqual(timeout, 180.0)
+
+    def test_longer_outputs_get_more_time(self):
+        self.fill(4.0)
+        short = self.tracker.timeout_for("ollama", "llama3.2:1b", "http://localhost:11434", 50)
+        long = self.tracker.timeout_for("ollama", "llama3.2:1b", "http://localhost:11434", 400)
+        self.assertGreater(long, short)
+
+    def test_hosts_are_tracked_separately(self):
+        self.fill(40.0)
+        self.assertEqual(self.tracker.timeout_for("ollama", "llama3.2:1b", "http://gpu-box:11434"),
+                         cancellation.timeout_for("ollama"))
+
+    def test_configure_overrides(self):
+        self.tracker.configure({"multiplier": 2, "min": 1, "max": 10})
+        self.fill(100.0)
+        self.assertEqual(self.tracker.timeout_for("ollama", "llama3.2:1b", "http://localhost:11434"), 10.0)
+
+    def test_timeouts_back_off_until_there_are_samples(self):
+        default = cancellation.timeout_for("ollama")
+        self.tracker.record_timeout("ollama", "llama3.2:1b", "", default)
+        self.assertEqual(self.tracker.timeout_for("ollama", "llama3.2:1b"), default * 2)
+        self.tracker.record_timeout("ollama", "llama3.2:1b", "", default * 2)
+        self.assertEqual(self.tracker.timeout_for("ollama", "llama3.2:1b"), default * 4)
+
+    def test_timeouts_widen_a_full_window_until_a_call_succeeds(self):
+        # A warm model that is unloaded reloads slower than its window allows
+        host = "http://localhost:11434"
+        self.fill(2.0)
+        warm = self.tracker.timeout_for("ollama", "llama3.2:1b", host, 50)
+        self.tracker.record_timeout("ollama", "llama3.2:1b", host, warm)
+        self.assertEqual(self.tracker.timeout_for("ollama", "llama3.2:1b", host, 50), warm * 2)
+        self.tracker.record_timeout("ollama", "llama3.2:1b", host, warm * 2)
+        self.assertEqual(self.tracker.timeout_for("ollama", "llama3.2:1b", host, 50), warm * 4)
+        # The reload finishes, then the model is warm again
+        self.tracker.record("ollama", "llama3.2:1b", host, 15.0, "word " * 50)
+        self.assertEqual(self.tracker.timeout_for("ollama", "llama3.2:1b", host, 50), 45.0)
+        # From here on the window alone sets the deadline
+        self.tracker.record("ollama", "llama3.2:1b", host, 1.5, "word " * 50)
+        self.assertNotIn(("ollama", "llama3.2:1b", host), self.tracker._floors)
+
+    def test_connect_timeout_is_short(self):
+        self.assertEqual(timeouts.http_timeout(60.0), (timeouts.CONNECT_TIMEOUT, 60.0 + timeouts.READ_SLACK))
+        self.assertIsNone(timeouts.http_timeout(None))
+
+
+
+class ApiError(Exception):
+    """Shaped like the SDK errors: a status code and the response headers."""
+
+    def __init__(self, status_code, headers=None):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+        self.response = type("Response", (), {"headers": headers or {}, "status_code": status_code})()
+
+
+class TestKeyPool(unittest.TestCase):
+    """Several API keys per provider, balanced on reported quota."""
+
+    def setUp(self):
+        self.pool = key_pool.KeyPool()
+        self.pool.configure({"openai": ["sk-a", "sk-b", "sk-c"], "anthropic": "sk-ant", "google": ""})
+
+    def test_config_accepts_a_list_or_a_single_key(self):
+        self.assertEqual(self.pool.keys("openai"), ["sk-a", "sk-b", "sk-c"])
+        self.assertEqual(self.pool.keys("anthropic"), ["sk-ant"])
+        self.assertEqual(self.pool.keys("google"), [])
+        self.assertEqual(self.pool.keys("anthropic", "sk-node"), ["sk-node", "sk-ant"])
+        self.assertIsNone(self.pool.acquire("google"))
+
+    def test_concurrent_requests_spread_evenly(self):
+        taken = [self.pool.acquire("openai") for _ in range(9)]
+        self.assertEqual(sorted(taken), ["sk-a"] * 3 + ["sk-b"] * 3 + ["sk-c"] * 3)
+
+    def test_key_with_most_remaining_quota_wins(self):
+        for key, remaining in (("sk-a", "5"), ("sk-b", "400"), ("sk-c", "20")):
+            self.pool.record("openai", key, {"x-ratelimit-remaining-requests": remaining,
+                                             "x-ratelimit-limit-requests": "500",
+                                             "x-ratelimit-reset-requests": "6m0s"})
+        self.assertEqual(self.pool.acquire("openai"), "sk-b")
+
+    def test_throttled_key_is_ejected_until_reset(self):
+        self.assertTrue(self.pool.report_error("openai", "sk-a", ApiError(429, {"retry-after": "20"})))
+        self.assertTrue(self.pool.ejected("openai", "sk-a"))
+        self.assertNotIn("sk-a", [self.pool.acquire("openai") for _ in range(4)])
+
+    def test_invalid_key_is_ejected_and_other_errors_are_not(self):
+        self.assertFalse(self.pool.report_error("openai", "sk-b", RuntimeError("no status")))
+        try:
+            try:
+                raise ApiError(401)
+            except ApiError:
+                raise RuntimeError("Failed to enhance prompt")
+        except RuntimeError as wrapped:
+            self.assertTrue(self.pool.report_error("openai", "sk-b", wrapped))
+        self.assertTrue(self.pool.ejected("openai", "sk-b"))
+        self.assertFalse(self.pool.report_error("openai", "sk-c", ApiError(500)))
+
+    def test_all_ejected_uses_the_first_to_return(self):
+        self.pool.eject("openai", "sk-a", 50)
+        self.pool.eject("openai", "sk-b", 5)
+        self.pool.eject("openai", "sk-c", 500)
+        self.assertEqual(self.pool.acquire("openai"), "sk-b")
+
+    def test_release_frees_the_slot(self):
+        key = self.pool.acquire("anthropic")
+        self.assertEqual(self.pool.in_flight("anthropic", key), 1)
+        self.pool.release("anthropic", key)
+        self.assertEqual(self.pool.in_flight("anthropic", key), 0)
+
+    def test_reset_header_formats(self):
+        now = 1_800_000_000.0
+        self.assertEqual(key_pool.parse_reset("6m0s", now), 360.0)
+        self.assertAlmostEqual(key_pool.parse_reset("250ms", now), 0.25)
+        self.assertEqual(key_pool.parse_reset("12", now), 12.0)
+        self.assertEqual(key_pool.parse_reset(str(int((now + 30) * 1000)), now), 30.0)
+        self.assertEqual(key_pool.parse_reset("2027-01-15T08:00:30Z", now), 30.0)
+
+    def test_anthropic_headers(self):
+        remaining, limit, _ = key_pool.parse_headers({"Anthropic-Ratelimit-Requests-Remaining": "49",
+                                                      "Anthropic-Ratelimit-Requests-Limit": "50"})
+        self.assertEqual((remaining, limit), (49.0, 50.0))
+
+    def test_google_keys_do_not_cross_between_concurrent_calls(self):
+        import prompt_enhancer_llm
+
+        class Service:
+            """Stands in for google.ai.generativelanguage: a client per key."""
+
+            class GenerativeServiceClient:
+                def __init__(self, client_options):
+                    self.api_key = client_options["api_key"]
+
+                def generate_content(self, prompt):
+                    time.sleep(0.2)
+                    return type("Response", (), {"text": self.api_key})()
+
+        class Genai:
+            """Stands in for google.generativeai, whose default client has one process-wide key."""
+            default = Service.GenerativeServiceClient({"api_key": "process-wide"})
+
+            @classmethod
+            def configure(cls, api_key):
+                cls.default = Service.GenerativeServiceClient({"api_key": api_key})
+
+            class GenerativeModel:
+                def __init__(self, model):
+                    self._client = None
+
+                def generate_content(self, prompt, **kwargs):
+                    return (self._client or Genai.default).generate_content(prompt)
+
+        for name, stand_in in (("genai_client", Genai), ("genai_service", Service)):
+            self.addCleanup(setattr, prompt_enhancer_llm, name, getattr(prompt_enhancer_llm, name))
+            setattr(prompt_enhancer_llm, name, stand_in)
+        node = PromptEnhancer()
+        answers = {}
+
+        def call(key):
+            answers[key] = node._enhance_google("system", "prompt", key, "gemini-2.5-flash")
+
+        threads = [threading.Thread(target=call, args=(key,)) for key in ("key-a", "key-b")]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(answers, {"key-a": "key-a", "key-b": "key-b"})
+        # The two requests overlap rather than queueing behind each other
+        self.assertLess(time.monotonic() - started, 0.35)
+
+
+class TestWildcards(unittest.TestCase):
+    """{a|b} and __name__ expansion, without building the whole space."""
+
+    def test_combinatorial_order(self):
+        self.assertEqual(
+            list(wildcards.expand("{red|blue} car at {dawn|night}", limit=10)),
+            ["red car at dawn", "red car at night", "blue car at dawn", "blue car at night"],
+        )
+
+    def test_limit_caps_the_variants(self):
+        self.assertEqual(len(list(wildcards.expand("{a|b|c} {d|e|f}", limit=4))), 4)
+
+    def test_nested_optional_and_escaped(self):
+        self.assertEqual(
+            list(wildcards.expand("{big {red|blue}|small}{| shiny} \\{x\\}", limit=10)),
+            ["big red {x}", "big red shiny {x}", "big blue {x}", "big blue shiny {x}", "small {x}",
+             "small shiny {x}"],
+        )
+
+    def test_unbalanced_braces_are_text(self):
+        self.assertEqual(list(wildcards.expand("a {red car", limit=10)), ["a {red car"])
+
+    def test_off_leaves_the_prompt_alone(self):
+        self.assertEqual(list(wildcards.expand("{red|blue} car", "off")), ["{red|blue} car"])
+
+    def test_huge_space_is_sampled_lazily(self):
+        prompt = "{a|b|c} " * 40
+        self.assertEqual(wildcards.count(prompt), 3 ** 40)
+        first = list(wildcards.expand(prompt, "random", 5, seed=3))
+        self.assertEqual(len(set(first)), 5)
+        self.assertEqual(first, list(wildcards.expand(prompt, "random", 5, seed=3)))
+        self.assertNotEqual(first, list(wildcards.expand(prompt, "random", 5, seed=4)))
+
+    def test_random_small_space_has_no_repeats(self):
+        drawn = list(wildcards.expand("{a|b|c}", "random", 10, seed=1))
+        self.assertEqual(sorted(drawn), ["a", "b", "c"])
+
+    def test_wildcard_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, "colors.txt"), "w") as f:
+                f.write("# a comment\nred\n\n{dark|light} blue\n")
+            files = wildcards.WildcardFiles(directory)
+            self.assertEqual(list(wildcards.expand("__colors__ car", limit=10, wildcard_files=files)),
+                             ["red car", "dark blue car", "light blue car"])
+            self.assertEqual(list(wildcards.expand("__missing__ car", limit=10, wildcard_files=files)),
+                             ["__missing__ car"])
+            self.assertIsNone(files.lines("../colors"))
+
+    def test_node_returns_one_entry_per_variant(self):
+        node = PromptEnhancer()
+        sentinel_clip = object()
+        clips, texts, _, negatives = node.enhance_prompt(
+            clip=sentinel_clip,
+            prompt="{red|blue|red} bicycle",
+            llm_provider="none",
+            style="Basic Styles > none",
+            expand_wildcards="combinatorial",
+        )
+        self.assertEqual(texts, ["red bicycle", "blue bicycle"])
+        self.assertEqual(len(clips), 2)
+        self.assertEqual(negatives, ["", ""])
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)
+
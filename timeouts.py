@@ -0,0 +1,146 @@
+"""Per-request timeouts derived from observed latency.
+
+A fixed timeout is wrong in both directions: long enough for a slow local
+model on CPU, it leaves a dead hosted endpoint hanging for a minute. This
+module keeps a rolling window of recent calls per (provider, model, host), and
+sizes each timeout from the window:
+
+    timeout = multiplier * max(p95 latency, p95 seconds per output token * expected tokens)
+
+clamped to ``[min, max]``. Until a key has a few samples the static
+defaults in ``cancellation`` apply. A call that times out adds no sample, so
+each timeout instead doubles a floor under the next deadline, whether it comes
+from the default or the window. A model that turns slow (reloading after it
+was unloaded, say) then gets the time it needs rather than being cut off at
+the old deadline forever. The next call that succeeds brings the floor down to
+what that call needed. Connecting
+gets its own short limit, so an endpoint that is down fails in seconds
+whatever the read timeout is.
+
+Multiplier, bounds and percentile can be set under ``"timeouts"`` in
+``config/llm_config.json``.
+"""
+
+import math
+import threading
+from collections import deque
+
+try:
+    from . import cancellation
+    from .prompts import count_tokens
+except ImportError:
+    import cancellation
+    from prompts import count_tokens
+
+MULTIPLIER = 3.0
+MIN_TIMEOUT = 5.0
+MAX_TIMEOUT = 180.0
+PERCENTILE = 0.95
+CONNECT_TIMEOUT = 3.0
+# The HTTP read timeout runs this much past the call deadline, so the deadline
+# always fires first and a timeout is reported the same way for every provider.
+READ_SLACK = 1.0
+
+WINDOW = 100
+# Samples needed before the window is trusted over the static default.
+MIN_SAMPLES = 5
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of ``values`` (0 < q <= 1)."""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))
+    return ordered[index]
+
+
+class LatencyTracker:
+    """Rolling latency and per-token rate samples per (provider, model, host)."""
+
+    def __init__(self, multiplier=MULTIPLIER, min_timeout=MIN_TIMEOUT, max_timeout=MAX_TIMEOUT,
+                 q=PERCENTILE, window=WINDOW):
+        self.multiplier = multiplier
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.q = q
+        self.window = window
+        self._lock = threading.Lock()
+        self._samples = {}  # key -> deque of (latency, seconds per output token)
+        self._floors = {}   # key -> least timeout to allow, raised by timeouts
+
+    def configure(self, settings):
+        """Apply ``{"multiplier", "min", "max", "percentile"}`` overrides."""
+        settings = settings or {}
+        self.multiplier = float(settings.get("multiplier", self.multiplier))
+        self.min_timeout = float(settings.get("min", self.min_timeout))
+        self.max_timeout = float(settings.get("max", self.max_timeout))
+        self.q = float(settings.get("percentile", self.q))
+
+    def record(self, provider, model, host, latency, output_text=""):
+        """Add a successful call. Output tokens are estimated from the text."""
+        tokens = max(1, count_tokens(output_text))
+        key = (provider, model, host or "")
+        with self._lock:
+            samples = self._samples.setdefault(key, deque(maxlen=self.window))
+            samples.append((latency, latency / tokens))
+            if key in self._floors:
+                # The floor only has to cover calls like this one now
+                floor = min(self._floors[key], self.multiplier * latency)
+                if floor <= self.min_timeout:
+                    del self._floors[key]
+                else:
+                    self._floors[key] = floor
+
+    def record_timeout(self, provider, model, host, timeout):
+        """A call ran out of time. Allow twice as long next time."""
+        key = (provider, model, host or "")
+        with self._lock:
+            self._floors[key] = min(self.max_timeout, max(self._floors.get(key, 0.0), timeout * 2))
+
+    def stats(self, provider, model, host=""):
+        """``(count, latency percentile, per-token percentile)`` for a key."""
+        with self._lock:
+            samples = list(self._samples.get((provider, model, host or ""), ()))
+        if not samples:
+            return 0, None, None
+        return (
+            len(samples),
+            percentile([latency for latency, _ in samples], self.q),
+            percentile([rate for _, rate in samples], self.q),
+        )
+
+    def timeout_for(self, provider, model, host="", expected_tokens=200):
+        """Seconds to allow the next call, from the window or the static default."""
+        count, latency, rate = self.stats(provider, model, host)
+        with self._lock:
+            floor = self._floors.get((provider, model, host or ""), 0.0)
+        if count < MIN_SAMPLES:
+            return max(cancellation.timeout_for(provider), floor)
+        estimate = max(latency, rate * expected_tokens)
+        return max(floor, min(self.max_timeout, max(self.min_timeout, self.multiplier * estimate)))
+
+
+tracker = LatencyTracker()
+
+
+def timeout_for(provider, model, host="", expected_tokens=200):
+    return tracker.timeout_for(provider, model, host, expected_tokens)
+
+
+def http_timeout(timeout):
+    """``(connect, read)`` for requests, so a dead host fails on connect."""
+    if not timeout:
+        return None
+    return (min(CONNECT_TIMEOUT, timeout), timeout + READ_SLACK)
+
+
+def sdk_timeout(timeout):
+    """The httpx timeout the OpenAI and Anthropic SDKs take, with a short connect."""
+    if not timeout:
+        return None
+    try:
+        import httpx
+    except ImportError:
+        return timeout + READ_SLACK
+    return httpx.Timeout(timeout + READ_SLACK, connect=min(CONNECT_TIMEOUT, timeout))
@@ -0,0 +1,276 @@
+"""Opt-in span tracing and profiling for the enhancement pipeline.
+
+Off by default. Turn it on with the node's ``trace`` input or by setting
+``PROMPT_ENHANCER_TRACE=1``. Each traced execution writes a Chrome trace-event
+file (open it in ``chrome://tracing`` or https://ui.perfetto.dev) to
+``PROMPT_ENHANCER_TRACE_DIR``, or ``traces/`` next to this file.
+
+``PROMPT_ENHANCER_PROFILE=N`` also runs the next N executions under cProfile
+and saves a ``.pstats`` file for each. Add ``PROMPT_ENHANCER_PROFILE_MEMORY=1``
+to record tracemalloc's top allocations alongside.
+
+The profile covers the executor thread and every helper thread the provider
+call runs on. ``cancellation`` wraps each call with ``profile_call``, which
+profiles it on its own thread, and pauses the executor's profiler while it
+waits, so an async run does not profile whatever else the event loop does in
+the meantime. The pieces are merged into one ``.pstats`` file at the end.
+
+When nothing is enabled, ``span()`` is one context variable lookup that
+returns a shared no-op context manager.
+"""
+
+import contextvars
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger('prompt_enhancer')
+
+TRACE_ENV = "PROMPT_ENHANCER_TRACE"
+TRACE_DIR_ENV = "PROMPT_ENHANCER_TRACE_DIR"
+PROFILE_ENV = "PROMPT_ENHANCER_PROFILE"
+PROFILE_MEMORY_ENV = "PROMPT_ENHANCER_PROFILE_MEMORY"
+
+DEFAULT_TRACE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "traces")
+
+_current = contextvars.ContextVar("prompt_enhancer_trace", default=None)
+_profile_lock = threading.Lock()
+_profile_runs_left = None
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("trace", "name", "args", "start")
+
+    def __init__(self, trace, name, args):
+        self.trace = trace
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.trace.add(self.name, self.start, end, self.args)
+        return False
+
+    def set(self, **args):
+        """Attach extra arguments to the span, e.g. token counts."""
+        self.args.update(args)
+
+
+class Trace:
+    """Spans recorded during one node execution."""
+
+    def __init__(self, name):
+        self.name = name
+        self.origin = time.perf_counter()
+        self.wall_start = time.time()
+        self.events = []
+        self.profiler = None  # the executor thread's, while profiling
+        self.profiles = []    # finished helper thread profiles
+        self._lock = threading.Lock()
+
+    def add_profile(self, profiler):
+        with self._lock:
+            self.profiles.append(profiler)
+
+    def add(self, name, start, end, args=None):
+        self.events.append({
+            "name": name,
+            "ph": "X",
+            "ts": round((start - self.origin) * 1e6, 3),
+            "dur": round((end - start) * 1e6, 3),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": args or {},
+        })
+
+    def to_chrome(self):
+        """The Chrome trace-event JSON object format."""
+        return {
+            "traceEvents": self.events,
+            "displayTimeUnit": "ms",
+            "otherData": {"name": self.name, "started": self.wall_start},
+        }
+
+
+def span(name, **args):
+    """Time a block under ``name``. A no-op unless a trace is active."""
+    trace = _current.get()
+    if trace is None:
+        return _NULL_SPAN
+    return _Span(trace, name, args)
+
+
+def _enable(profiler):
+    """Start ``profiler``. False when another one already covers this thread.
+
+    From Python 3.12 a profiler sees every thread and only one can run at a
+    time, so a helper thread is then already being profiled.
+    """
+    try:
+        profiler.enable()
+        return True
+    except ValueError:
+        return False
+
+
+def profile_call(fn):
+    """Wrap ``fn`` so the thread that runs it is profiled with the active run.
+
+    Returns ``fn`` unchanged unless the current execution is being profiled.
+    """
+    trace = _current.get()
+    if trace is None or trace.profiler is None:
+        return fn
+
+    @functools.wraps(fn)
+    def profiled(*args, **kwargs):
+        import cProfile
+        profiler = cProfile.Profile()
+        if not _enable(profiler):
+            return fn(*args, **kwargs)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profiler.disable()
+            trace.add_profile(profiler)
+
+    return profiled
+
+
+@contextmanager
+def paused():
+    """Stop profiling the executor thread while it waits on a helper."""
+    trace = _current.get()
+    if trace is None or trace.profiler is None:
+        yield
+        return
+    trace.profiler.disable()
+    try:
+        yield
+    finally:
+        _enable(trace.profiler)
+
+
+def _dump_profile(trace, path):
+    import pstats
+    stats = pstats.Stats(trace.profiler)
+    for profiler in trace.profiles:
+        stats.add(profiler)
+    stats.dump_stats(path)
+
+
+def trace_dir():
+    return os.environ.get(TRACE_DIR_ENV) or DEFAULT_TRACE_DIR
+
+
+def _env_enabled(name):
+    return os.environ.get(name, "").strip().lower() not in ("", "0", "false", "no", "off")
+
+
+def _take_profile_slot():
+    """Claim one of the ``PROMPT_ENHANCER_PROFILE`` runs, if any are left."""
+    global _profile_runs_left
+    with _profile_lock:
+        if _profile_runs_left is None:
+            try:
+                _profile_runs_left = max(0, int(os.environ.get(PROFILE_ENV, "0") or 0))
+            except ValueError:
+                _profile_runs_left = 0
+        if _profile_runs_left <= 0:
+            return False
+        _profile_runs_left -= 1
+        return True
+
+
+def _write(filename, writer):
+    directory = trace_dir()
+    try:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, filename)
+        writer(path)
+        return path
+    except OSError as e:
+        logger.error(f"Error writing {filename}: {e}")
+        return None
+
+
+@contextmanager
+def run(name, enabled=False):
+    """Trace (and maybe profile) one execution. Yields the Trace or None."""
+    enabled = enabled or _env_enabled(TRACE_ENV)
+    profiling = _take_profile_slot()
+    if not enabled and not profiling:
+        yield None
+        return
+
+    trace = Trace(name)
+    token = _current.set(trace)
+    profiler = None
+    memory = profiling and _env_enabled(PROFILE_MEMORY_ENV)
+    if profiling:
+        import cProfile
+        profiler = trace.profiler = cProfile.Profile()
+    if memory:
+        import tracemalloc
+        tracemalloc.start()
+    stamp = time.strftime("%Y%m%d-%H%M%S") + f"-{int(trace.wall_start * 1000) % 1000:03d}"
+    start = time.perf_counter()
+    try:
+        if profiler:
+            _enable(profiler)
+        yield trace
+    finally:
+        if profiler:
+            profiler.disable()
+        end = time.perf_counter()
+        args = {}
+        if memory:
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+            args["tracemalloc_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            top = snapshot.statistics("lineno")[:25]
+            _write(f"memory-{stamp}.txt", lambda p: _write_lines(p, [str(stat) for stat in top]))
+        trace.add(name, start, end, args)
+        _current.reset(token)
+        if profiler:
+            path = _write(f"profile-{stamp}.pstats", lambda p: _dump_profile(trace, p))
+            if path:
+                logger.info(f"Wrote profile to {path}")
+        path = _write(f"trace-{stamp}.json", lambda p: _write_json(p, trace.to_chrome()))
+        if path:
+            logger.info(f"Wrote trace to {path}")
+
+
+def _write_json(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f)
+
+
+def _write_lines(path, lines):
+    with open(path, 'w') as f:
+        f.write("\n".join(lines))
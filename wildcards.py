@@ -0,0 +1,214 @@
+"""Expands ``{red|blue|green} car at {dawn|night}`` into prompt variants.
+
+Two kinds of placeholder:
+
+* ``{a|b|c}`` picks one of the options. Options can hold placeholders of
+  their own, and ``{|b}`` makes a part optional.
+* ``__name__`` picks a line of ``config/wildcards/name.txt``. A name without
+  a file is left as written.
+
+``\\{``, ``\\}``, ``\\|`` and ``\\_`` are literal characters.
+
+A prompt is parsed once into a small tree that knows how many variants it has,
+and variant number ``i`` is rendered straight from the tree. Nothing ever
+builds the full list, so ``{a|b|c}`` repeated 40 times (about 10**19 variants)
+costs no more than the variants actually asked for. Random mode samples
+indices, without repeats, from the same numbering.
+"""
+
+import os
+import random
+import re
+import threading
+
+WILDCARD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config", "wildcards")
+
+MODES = ["off", "combinatorial", "random"]
+DEFAULT_MAX_VARIANTS = 16
+
+# Wildcard files that pull in other files stop here rather than loop forever.
+MAX_DEPTH = 8
+
+_WILDCARD = re.compile(r"__([\w./-]+?)__")
+
+
+class _Choice:
+    """One of several sequences."""
+
+    __slots__ = ("options", "count")
+
+    def __init__(self, options):
+        self.options = options
+        self.count = sum(option.count for option in options)
+
+    def render(self, index):
+        for option in self.options:
+            if index < option.count:
+                return option.render(index)
+            index -= option.count
+        raise IndexError(index)
+
+
+class _Sequence:
+    """Literal text and choices, one after another."""
+
+    __slots__ = ("parts", "count")
+
+    def __init__(self, parts):
+        self.parts = parts
+        self.count = 1
+        for part in parts:
+            if not isinstance(part, str):
+                self.count *= part.count
+
+    def render(self, index):
+        # Mixed radix, last choice fastest, like itertools.product
+        out = []
+        for part in reversed(self.parts):
+            if isinstance(part, str):
+                out.append(part)
+            else:
+                index, digit = divmod(index, part.count)
+                out.append(part.render(digit))
+        return "".join(reversed(out))
+
+
+class WildcardFiles:
+    """Lines of ``<directory>/<name>.txt``, read once and kept."""
+
+    def __init__(self, directory=WILDCARD_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._lines = {}
+
+    def lines(self, name):
+        """Non-empty, non-comment lines of the file, or None if there is no such file."""
+        with self._lock:
+            if name in self._lines:
+                return self._lines[name]
+        path = os.path.normpath(os.path.join(self.directory, name + ".txt"))
+        lines = None
+        # Names can have subfolders but can't climb out of the directory
+        if path.startswith(os.path.normpath(self.directory) + os.sep) and os.path.isfile(path):
+            with open(path, encoding="utf-8") as f:
+                lines = [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+        with self._lock:
+            self._lines[name] = lines or None
+        return lines or None
+
+
+files = WildcardFiles()
+
+
+class _Parser:
+    def __init__(self, text, wildcard_files, depth):
+        self.text = text
+        self.pos = 0
+        self.files = wildcard_files
+        self.depth = depth
+
+    def sequence(self, inside_braces=False):
+        parts = []
+        literal = []
+
+        def flush():
+            if literal:
+                parts.append("".join(literal))
+                literal.clear()
+
+        text = self.text
+        while self.pos < len(text):
+            char = text[self.pos]
+            if char == "\\" and self.pos + 1 < len(text) and text[self.pos + 1] in "{}|_\\":
+                literal.append(text[self.pos + 1])
+                self.pos += 2
+            elif inside_braces and char in "|}":
+                break
+            elif char == "{":
+                start = self.pos
+                choice = self.choice()
+                if choice is None:
+                    # Unbalanced brace: keep it as text
+                    self.pos = start + 1
+                    literal.append("{")
+                else:
+                    flush()
+                    parts.append(choice)
+            elif text.startswith("__", self.pos):
+                match = _WILDCARD.match(text, self.pos)
+                choice = self.wildcard(match.group(1)) if match else None
+                if choice is None:
+                    literal.append("__")
+                    self.pos += 2
+                else:
+                    flush()
+                    parts.append(choice)
+                    self.pos = match.end()
+            else:
+                literal.append(char)
+                self.pos += 1
+        flush()
+        return _Sequence(parts)
+
+    def choice(self):
+        """Parse ``{a|b}`` from the opening brace. None if it never closes."""
+        self.pos += 1
+        options = [self.sequence(inside_braces=True)]
+        while self.pos < len(self.text) and self.text[self.pos] == "|":
+            self.pos += 1
+            options.append(self.sequence(inside_braces=True))
+        if self.pos >= len(self.text) or self.text[self.pos] != "}":
+            return None
+        self.pos += 1
+        return _Choice(options)
+
+    def wildcard(self, name):
+        if self.depth >= MAX_DEPTH:
+            return None
+        lines = self.files.lines(name)
+        if not lines:
+            return None
+        return _Choice([_Parser(line, self.files, self.depth + 1).sequence() for line in lines])
+
+
+def parse(text, wildcard_files=None):
+    """The variant tree for ``text``. Its ``count`` is the number of variants."""
+    return _Parser(text, wildcard_files or files, 0).sequence()
+
+
+def count(text, wildcard_files=None):
+    return parse(text, wildcard_files).count
+
+
+def _sample_indices(rng, population, k):
+    """``k`` distinct indices below ``population``, which may be far past sys.maxsize."""
+    if population <= 2 * k:
+        # Small space: shuffle it
+        yield from rng.sample(range(population), k)
+        return
+    seen = set()
+    while len(seen) < k:
+        index = rng.randrange(population)
+        if index not in seen:
+            seen.add(index)
+            yield index
+
+
+def expand(text, mode="combinatorial", limit=DEFAULT_MAX_VARIANTS, seed=0, wildcard_files=None):
+    """Yield up to ``limit`` variants of ``text``, one at a time.
+
+    ``combinatorial`` goes through the variants in order. ``random`` draws
+    distinct variants with a ``seed``ed generator, so the same seed gives the
+    same set. ``off`` yields ``text`` untouched.
+    """
+    if mode == "off":
+        yield text
+        return
+    tree = parse(text, wildcard_files)
+    limit = min(tree.count, max(1, limit))
+    if mode == "random":
+        indices = _sample_indices(random.Random(seed), tree.count, limit)
+    else:
+        indices = range(limit)
+    for index in indices:
+        yield tree.render(index)